@@ -1,5 +1,5 @@
 from django.contrib import admin
-from api.models import User, Profile, Task, Message
+from api.models import User, Profile, Task, Message, Conversation, ConversationSummary
 
 class UserAdmin(admin.ModelAdmin):
     list_display = ['username', 'email']
@@ -20,7 +20,21 @@ class MessageAdmin(admin.ModelAdmin):
 
     list_display = ['sender', 'receiver', 'is_read', 'message', 'date',]
 
+    # the message delta sync has no tombstones, so a deleted message would
+    # stay on every synced device
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ['user_low', 'user_high', 'date']
+
+
+class ConversationSummaryAdmin(admin.ModelAdmin):
+    list_display = ['user', 'conversation', 'last_message_at', 'unread_count']
+
 admin.site.register(User, UserAdmin)
 admin.site.register(Profile, ProfileAdmin)
 admin.site.register(Task, TaskAdmin)
-admin.site.register(Message, MessageAdmin)
\ No newline at end of file
+admin.site.register(Message, MessageAdmin)
+admin.site.register(Conversation, ConversationAdmin)
+admin.site.register(ConversationSummary, ConversationSummaryAdmin)
\ No newline at end of file
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from api.cache import user_key
+from api.models import User
+
+
+def get_user(user_id):
+    """
+    The user a token's ``user_id`` claim refers to, cached for
+    ``AUTH_USER_CACHE_TIMEOUT`` seconds so repeated connections by the
+    same user do not query the users table. ``None`` if it does not exist.
+    The entry is dropped whenever the user is saved or one of their tokens
+    is blacklisted (see ``api/models.py``).
+    """
+    key = user_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if user is None:
+            return None
+        cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+    return user
+
+
+def user_from_token(raw_token):
+    """
+    Validates an access token in process (signature, expiry, token type)
+    and returns its user, or ``AnonymousUser`` if the token is invalid or
+    the user is missing or inactive.
+    """
+    try:
+        token = AccessToken(raw_token)
+    except TokenError:
+        return AnonymousUser()
+
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    user = get_user(user_id) if user_id is not None else None
+    if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+        return AnonymousUser()
+    return user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    ``JWTAuthentication`` that resolves the user through ``get_user`` rather
+    than querying the users table on every request. The checks after the
+    lookup are the same as SimpleJWT's.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        user = get_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
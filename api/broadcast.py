@@ -0,0 +1,19 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+def group_send(group, message):
+    """
+    Sends a channel layer event from synchronous code after the change it
+    announces was stored. Live delivery is best effort: if the channel
+    layer is down the failure is logged instead of failing the request,
+    and clients catch up with the REST endpoints or a delta sync.
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(group, message)
+    except Exception:
+        logger.exception("Could not send %s to group %s", message.get("type"), group)
@@ -0,0 +1,95 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def _version_key(user_id):
+    return f"profile:version:{user_id}"
+
+
+def _owner_key(profile_id):
+    return f"profile:owner:{profile_id}"
+
+
+def user_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def invalidate_user(user_id):
+    """
+    Drops the user cached for authentication (api/authentication.py).
+    """
+    cache.delete(user_key(user_id))
+
+
+def _new_version():
+    # a lost version key must never restart at a number an old ETag used
+    return time.time_ns() // 1000
+
+
+def profile_version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_profile(user_id):
+    """
+    Moves the user's cached profile representations to a new version.
+    The old entries are never read again and expire on their own.
+    """
+    key = _version_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+def invalidate_profiles(user_ids):
+    for user_id in user_ids:
+        invalidate_profile(user_id)
+
+
+def profile_owner(profile_id, lookup):
+    """
+    ``user_id`` of a profile by primary key; the mapping never changes,
+    so it is cached without a version. ``lookup`` runs on a miss.
+    """
+    key = _owner_key(profile_id)
+    user_id = cache.get(key)
+    if user_id is None:
+        user_id = lookup()
+        cache.set(key, user_id, settings.PROFILE_CACHE_TIMEOUT)
+    return user_id
+
+
+def cached_profile_response(request, kind, user_id, build):
+    """
+    Response for one representation (``kind``) of a user's profile.
+
+    The ETag is derived from the profile version alone, so a matching
+    ``If-None-Match`` is answered with 304 before anything is loaded or
+    serialized. Otherwise the serialized data comes from the cache and
+    ``build()`` only runs on a miss.
+    """
+    version = profile_version(user_id)
+    etag = quote_etag(f"{kind}-{user_id}-{version}")
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == "*"):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    key = f"profile:{kind}:{user_id}:{version}"
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, settings.PROFILE_CACHE_TIMEOUT)
+    return Response(data, headers=headers)
@@ -1,20 +1,129 @@
-import json
+import asyncio
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from redis import RedisError
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from api.models import Profile
+from api import message_queue, online_tracker
+from api.serialization import MSGPACK_SUBPROTOCOL, dumps, event_text, frame_text, loads, msgpack, pack, unpack
+from api.models import Conversation, ConversationSummary, Message, Profile, User
+from api.serializer import MarkReadSerializer
+from api.presence import broadcaster, contact_groups, presence_group
+from api.task_events import task_group
 
-class OnlineUserConsumer(AsyncWebsocketConsumer):
-    group_name = "online_users"
+MAX_MESSAGE_LENGTH = Message._meta.get_field("message").max_length
+
+
+def message_error(text):
+    """
+    Why ``text`` cannot be stored as a chat message, or None if it can.
+    Checked before a message is queued or broadcast, since the batch writer
+    would only drop it later.
+    """
+    if not isinstance(text, str) or not 0 < len(text) <= MAX_MESSAGE_LENGTH:
+        return f"message must be a non-empty string of at most {MAX_MESSAGE_LENGTH} characters."
+    return None
+
+
+class WireFormatMixin:
+    """
+    Frames are JSON text by default. A client that offers the ``msgpack``
+    subprotocol gets MessagePack binary frames with the short keys of
+    ``api.serialization.COMPACT_KEYS`` and may send binary frames too.
+
+    JSON events from a group_send arrive pre-encoded (``"text"``); for
+    MessagePack they are packed per socket from the event fields.
+    """
+    binary = False
+
+    def negotiate_subprotocol(self):
+        """
+        The subprotocol to accept the connection with.
+        """
+        self.binary = msgpack is not None and MSGPACK_SUBPROTOCOL in (self.scope.get("subprotocols") or [])
+        return MSGPACK_SUBPROTOCOL if self.binary else self.scope.get("auth_subprotocol")
+
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        A frame from the client, or None if it cannot be decoded.
+        """
+        try:
+            if bytes_data is not None:
+                return unpack(bytes_data) if msgpack is not None else None
+            return loads(text_data)
+        except (ValueError, TypeError):
+            # JSON and MessagePack decode errors are ValueErrors; TypeError
+            # is a MessagePack map with unhashable keys
+            return None
+
+    def item(self, obj):
+        """
+        ``obj`` ready to be sent alone (``encode_batch`` of one) or in a batch.
+        """
+        return obj if self.binary else dumps(obj)
+
+    def event_item(self, event, build):
+        """
+        Like ``item(build())``, but reuses the JSON the sender encoded.
+        """
+        return build() if self.binary else frame_text(event, build)
+
+    def encode(self, item):
+        return pack(item) if self.binary else item
+
+    def encode_batch(self, items):
+        # JSON items are already encoded, so the array is joined, not re-encoded
+        return pack(items) if self.binary else "[" + ",".join(items) + "]"
+
+    async def send_frame(self, frame):
+        if self.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+
+class OnlineUserConsumer(WireFormatMixin, AsyncWebsocketConsumer):
+    """
+    Presence protocol. A user only sees the presence of their contacts
+    (people they have exchanged messages with); each user's sockets share
+    one ``presence_<user_id>`` group that only those contacts publish to.
+
+    - on connect (and on a client ``{"type": "resync"}``) the socket gets a
+      snapshot: ``{"type": "online_users", "seq": N, "data": [...]}``
+    - afterwards only deltas are broadcast:
+      ``{"type": "presence", "seq": N, "joined": [...], "left": [user_id, ...]}``
+
+    Changes are coalesced by ``api.presence.broadcaster``, so one delta may
+    carry many users. Every delta bumps ``seq`` by one. A client that sees
+    a jump in ``seq`` missed an event and should send ``resync``; deltas
+    with a ``seq`` not greater than the snapshot's are already included.
+
+    Frames are JSON or MessagePack, see ``WireFormatMixin``.
+    """
+    heartbeat_task = None
+
+    async def __call__(self, scope, receive, send):
+        # disconnect() is not called when the consumer fails, and a
+        # heartbeat left running would keep the user online for good
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
 
     async def connect(self):
         self.user = self.scope["user"]
         print("CONNECTED USER:", self.user, self.user.is_authenticated)
 
         if self.user.is_authenticated:
+            self.group_name = presence_group(self.user.id)
             await self.channel_layer.group_add(self.group_name, self.channel_name)
-            await self.accept()
-            await self.set_online()
-            await self.send_online_users_group()
+            await self.accept(self.negotiate_subprotocol())
+            await self.send_snapshot()
+            if await self.set_online():
+                await self.send_joined()
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
         else:
             print("NOT AUTHENTICATED")
             await self.close()
@@ -22,85 +131,433 @@ class OnlineUserConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         if self.user.is_authenticated:
-            await self.set_offline()
-            await self.send_online_users_group()
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+            if await self.set_offline():
+                await self.send_left()
 
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
-    async def receive(self, text_data):
-        pass
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode(text_data, bytes_data)
+        if isinstance(data, dict) and data.get("type") == "resync":
+            await self.send_snapshot()
+
+    async def heartbeat(self):
+        """
+        Keeps this connection alive in Redis. If the worker dies the
+        heartbeats stop and the connection expires after PRESENCE_TTL.
+        """
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            if await self.set_online():
+                await self.send_joined()
 
-    async def send_online_users_group(self):
-        users = await self.get_online_users()
-        message = {
+    async def send_snapshot(self):
+        seq, users = await self.get_snapshot()
+        await self.send_frame(self.encode(self.item({
             "type": "online_users",
+            "seq": seq,
             "data": users
-        }
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                "type": "online_users_message",
-                "message": message,
-            }
-        )
+        })))
+
+    async def send_joined(self):
+        user_info = await self.get_user_info()
+        for group in await self.get_contact_groups():
+            broadcaster.publish(group, joined=[user_info])
+
+    async def send_left(self):
+        for group in await self.get_contact_groups():
+            broadcaster.publish(group, left=[self.user.id])
 
     async def online_users_message(self, event):
-        await self.send(text_data=json.dumps(event["message"]))
+        await self.send_frame(self.encode(self.event_item(event, lambda: event["message"])))
 
-    @database_sync_to_async
+    @sync_to_async(thread_sensitive=False)
     def set_online(self):
-        profile = Profile.objects.get(user=self.user)
-        profile.is_online = True
-        profile.save()
+        return online_tracker.add_connection(self.user.id, self.channel_name)
 
-    @database_sync_to_async
+    @sync_to_async(thread_sensitive=False)
     def set_offline(self):
-        profile = Profile.objects.get(user=self.user)
-        profile.is_online = False
-        profile.save()
+        return online_tracker.remove_connection(self.user.id, self.channel_name)
 
     @database_sync_to_async
-    def get_online_users(self):
-        return list(Profile.objects.filter(is_online=True)
-                    .values('user__username', 'name', 'is_online'))
+    def get_contact_groups(self):
+        return contact_groups(self.user.id)
+
+    @database_sync_to_async
+    def get_user_info(self):
+        return {
+            "user_id": self.user.id,
+            "user__username": self.user.username,
+            "name": Profile.objects.values_list('name', flat=True).get(user=self.user),
+            "is_online": True,
+        }
+
+    @database_sync_to_async
+    def get_snapshot(self):
+        # read the sequence first so every change after it arrives as a delta
+        seq = online_tracker.current_sequence(self.group_name)
+        user_ids = online_tracker.online_among(online_tracker.get_contacts(self.user.id))
+        users = [
+            dict(user, is_online=True)
+            for user in Profile.objects.filter(user_id__in=user_ids)
+                                       .values('user_id', 'user__username', 'name')
+        ]
+        return seq, users
+
 
+class ChatConsumer(WireFormatMixin, AsyncWebsocketConsumer):
+    """
+    Both participants join the conversation's group whatever order their
+    ids appear in the URL, so one group_send reaches every open socket of
+    the conversation.
 
-class ChatConsumer(AsyncWebsocketConsumer):
+    Protocol 1 (default): one JSON object per frame each way, e.g.
+    ``{"message": "..."}`` or ``{"type": "read", "up_to_uid": uid}`` in and
+    ``{"type": "chat_message", "message": {...}}`` out. A message that
+    cannot be stored is answered with ``{"type": "error", "error": "..."}``
+    to the sender only.
+
+    Protocol 2 (``?protocol=2``): a frame is one operation or an array of
+    them, up to ``CHAT_MAX_FRAME_ITEMS`` (larger frames are rejected whole
+    with an ``error`` event, as are frames that cannot be decoded):
+
+    - ``{"type": "message", "client_id": "<unique per sender>", "message": "..."}``
+    - ``{"type": "read", "up_to_uid": <message uid>}`` (or ``"up_to": <message id>``)
+
+    The server answers with arrays of events, collected for
+    ``CHAT_FLUSH_WINDOW`` seconds per socket: ``chat_message`` and
+    ``read_receipt`` as in protocol 1, plus one
+    ``{"type": "ack", "client_id": ..., "uid": ..., "status": ...}`` per
+    message, where ``status`` is ``accepted``, ``duplicate`` (already
+    accepted, safe to stop retrying) or ``rejected`` (with ``error``, not
+    stored). Operations that are not objects get an ``error`` event.
+    A message's ``uid`` is derived from the sender and ``client_id``, so
+    retries are dropped in Redis and, failing that, by the unique ``uid``.
+
+    Both protocols work over JSON or MessagePack, see ``WireFormatMixin``.
+    """
     async def connect(self):
         self.user = self.scope["user"]
-        self.room_name = f"{self.scope['url_route']['kwargs']['sender_id']}_{self.scope['url_route']['kwargs']['receiver_id']}"
-        self.room_group_name = f"chat_{self.room_name}"
+
+        # resolved once here so each message costs a single INSERT
+        self.conversation = await self.get_conversation()
+        if self.conversation is None:
+            await self.close()
+            return
+
+        self.room_group_name = self.conversation.group_name
+        versions = parse_qs(self.scope.get("query_string", b"").decode()).get("protocol")
+        self.protocol = 2 if versions and versions[0] == "2" else 1
+        self.outbox = []
+        self.flush_task = None
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(self.negotiate_subprotocol())
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.conversation is not None:
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode(text_data, bytes_data)
+        if self.protocol == 2:
+            if data is None:
+                await self.send_error("Invalid frame.")
+                return
+            await self.receive_batch(data if isinstance(data, list) else [data])
+            return
+
+        if not isinstance(data, dict):
+            return
+        if data.get("type") == "read":
+            await self.receive_read(data)
+            return
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        await self.save_message(data)
+        error = message_error(data.get("message"))
+        if error is not None:
+            await self.send_error(error)
+            return
+
+        if settings.CHAT_WRITE_BEHIND:
+            try:
+                data = await self.enqueue_message(data)
+            except RedisError:
+                # without the queue, fall back to writing the message directly
+                data = await self.save_message(data)
+        else:
+            data = await self.save_message(data)
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 "type": "chat_message",
-                "message": data
+                "message": data,
+                "text": event_text({"type": "chat_message", "message": data}),
             }
         )
 
+    async def receive_batch(self, items):
+        """
+        Protocol 2: stores all messages of a frame with one queue (or
+        database) write and delivers them with one group_send.
+        """
+        if len(items) > settings.CHAT_MAX_FRAME_ITEMS:
+            # nothing is applied, so the client can resend in smaller frames
+            await self.send_error(f"At most {settings.CHAT_MAX_FRAME_ITEMS} operations per frame.")
+            return
+
+        entries, acks, seen = [], [], set()
+        for item in items:
+            if not isinstance(item, dict):
+                await self.send_error("Operations must be objects.")
+                continue
+            if item.get("type") == "read":
+                await self.receive_read(item)
+                continue
+
+            client_id, text = item.get("client_id"), item.get("message")
+            if not isinstance(client_id, str) or not 0 < len(client_id) <= 64:
+                error = "client_id must be a string of 1 to 64 characters."
+            else:
+                error = message_error(text)
+            if error is not None:
+                acks.append({"type": "ack", "client_id": client_id, "status": "rejected", "error": error})
+                continue
+
+            uid = message_queue.client_uid(self.user.id, client_id)
+            acks.append({"type": "ack", "client_id": client_id, "uid": uid, "status": "duplicate"})
+            if uid not in seen:
+                seen.add(uid)
+                entry = message_queue.new_entry(self.conversation.id, self.user.id, self.receiver_id, text, uid)
+                entry["client_id"] = client_id
+                entries.append(entry)
+
+        accepted, dropped = await self.store_messages(entries) if entries else ([], set())
+        accepted_uids = {entry["uid"] for entry in accepted}
+        for ack in acks:
+            if ack.get("uid") in accepted_uids:
+                # only the first ack of a uid repeated within the frame
+                ack["status"] = "accepted"
+                accepted_uids.discard(ack["uid"])
+            elif ack.get("uid") in dropped:
+                ack.update(status="rejected", error="The message could not be stored.")
+
+        if accepted:
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    "type": "chat_messages",
+                    "messages": accepted,
+                    "texts": [event_text({"type": "chat_message", "message": entry}) for entry in accepted],
+                }
+            )
+        self.push(*(self.item(ack) for ack in acks))
+
+    async def store_messages(self, entries):
+        """
+        The entries accepted now and the uids of those the database refused.
+        Queued entries count as accepted.
+        """
+        if settings.CHAT_WRITE_BEHIND:
+            try:
+                return await self.enqueue_messages(entries), set()
+            except RedisError:
+                pass
+        return await self.save_messages(entries)
+
+    def push(self, *events):
+        """
+        Protocol 2: queues events (see ``WireFormatMixin.item``) for this
+        socket; they are sent together as one array at the end of the
+        flush window.
+        """
+        self.outbox.extend(events)
+        if self.outbox and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.CHAT_FLUSH_WINDOW)
+        self.flush_task = None
+        events, self.outbox = self.outbox, []
+        await self.send_frame(self.encode_batch(events))
+
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "chat_message",
-            "message": event["message"]
-        }))
+        item = self.event_item(event, lambda: {"type": "chat_message", "message": event["message"]})
+        if self.protocol == 2:
+            self.push(item)
+            return
+        await self.send_frame(self.encode(item))
+
+    async def chat_messages(self, event):
+        if self.binary or "texts" not in event:
+            items = [self.item({"type": "chat_message", "message": message}) for message in event["messages"]]
+        else:
+            items = event["texts"]
+        if self.protocol == 2:
+            self.push(*items)
+            return
+        for item in items:
+            await self.send_frame(self.encode(item))
+
+    async def receive_read(self, data):
+        """
+        ``{"type": "read", "up_to_uid": <message uid>}`` marks everything
+        the user received up to that message as read and tells the other
+        participant with a read receipt. ``uid`` is what delivered messages
+        carry; ``"up_to": <message id>`` (from the REST API) works too.
+        """
+        serializer = MarkReadSerializer(data=data)
+        if not serializer.is_valid():
+            await self.send_error(serializer.errors)
+            return
+
+        up_to = serializer.validated_data.get("up_to")
+        up_to_uid = serializer.validated_data.get("up_to_uid")
+        up_to_uid = str(up_to_uid) if up_to_uid is not None else None
+        if not await self.mark_read(up_to, up_to_uid):
+            return
+
+        receipt = {
+            "type": "read_receipt",
+            "reader": self.user.id,
+            "up_to": up_to,
+            "up_to_uid": up_to_uid,
+        }
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            dict(receipt, text=event_text(receipt)),
+        )
+
+    async def send_error(self, error):
+        item = self.item({"type": "error", "error": error})
+        if self.protocol == 2:
+            self.push(item)
+            return
+        await self.send_frame(self.encode(item))
+
+    async def read_receipt(self, event):
+        item = self.event_item(event, lambda: {
+            "type": "read_receipt",
+            "reader": event["reader"],
+            "up_to": event["up_to"],
+            "up_to_uid": event.get("up_to_uid"),
+        })
+        if self.protocol == 2:
+            self.push(item)
+            return
+        await self.send_frame(self.encode(item))
+
+    @database_sync_to_async
+    def get_conversation(self):
+        """
+        The conversation between the URL pair, or None if the connected
+        user is not part of it or the other user does not exist.
+        """
+        if not self.user.is_authenticated:
+            return None
+
+        kwargs = self.scope["url_route"]["kwargs"]
+        user_ids = {int(kwargs["sender_id"]), int(kwargs["receiver_id"])}
+        if self.user.id not in user_ids:
+            return None
+
+        self.receiver_id = (user_ids - {self.user.id}).pop() if len(user_ids) == 2 else self.user.id
+        if not User.objects.filter(id=self.receiver_id).exists():
+            return None
+        return Conversation.between(self.user.id, self.receiver_id)
+
+    @database_sync_to_async
+    def mark_read(self, up_to, up_to_uid):
+        """
+        Whether anything was (or, queued, will be) marked. A uid is marked
+        by the batch writer when write-behind is on, as the message may
+        still be queued.
+        """
+        if up_to_uid is not None and settings.CHAT_WRITE_BEHIND:
+            try:
+                message_queue.enqueue_read(self.user.id, self.conversation.id, up_to_uid)
+                return True
+            except RedisError:
+                pass
+        return ConversationSummary.mark_read(self.user.id, self.conversation.id, up_to, up_to_uid) > 0
+
+    @sync_to_async(thread_sensitive=False)
+    def enqueue_message(self, data):
+        return message_queue.enqueue(self.conversation.id, self.user.id, self.receiver_id, data["message"])
+
+    @sync_to_async(thread_sensitive=False)
+    def enqueue_messages(self, entries):
+        return message_queue.enqueue_unseen(entries, settings.CHAT_DEDUP_TTL)
+
+    @database_sync_to_async
+    def save_messages(self, entries):
+        existing, written = message_queue.store(entries)
+        if written:
+            try:
+                online_tracker.add_contact(self.user.id, self.receiver_id)
+            except RedisError:
+                # the cached contact list expires on its own
+                pass
+        written = {str(message.uid): message for message in written}
+        accepted = [
+            dict(entry, date=written[entry["uid"]].date.strftime("%Y-%m-%d %H:%M:%S"))
+            for entry in entries if entry["uid"] in written
+        ]
+        dropped = {entry["uid"] for entry in entries} - existing - set(written)
+        return accepted, dropped
 
     @database_sync_to_async
     def save_message(self, data):
-        from api.models import Message, Profile, User
-        sender = User.objects.get(id=data["sender"])
-        receiver = User.objects.get(id=data["receiver"])
-        return Message.objects.create(
-            sender=sender,
-            receiver=receiver,
+        message = Message.objects.create(
+            conversation=self.conversation,
+            user_id=self.user.id,
+            sender_id=self.user.id,
+            receiver_id=self.receiver_id,
             message=data["message"]
         )
+        try:
+            online_tracker.add_contact(self.user.id, self.receiver_id)
+        except RedisError:
+            # the cached contact list expires on its own
+            pass
+        return {
+            "uid": str(message.uid),
+            "sender": self.user.id,
+            "receiver": self.receiver_id,
+            "message": message.message,
+            "date": message.date.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+class TaskConsumer(AsyncWebsocketConsumer):
+    """
+    Pushes changes to the connected user's tasks to all of their sockets,
+    replacing polling of ``/todo/<user_id>/``:
+    ``{"type": "tasks", "events": [{"event": "created" | "updated" | "deleted", "task": {...}}]}``
+
+    ``task`` has the shape of ``/todo-sync/`` results. Changes made while a
+    socket was disconnected are not replayed, so clients should run a delta
+    sync from their last cursor after every (re)connect.
+    """
+    async def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.group_name = task_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept(self.scope.get("auth_subprotocol"))
+
+    async def disconnect(self, close_code):
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def task_events(self, event):
+        await self.send(text_data=frame_text(event, lambda: {
+            "type": "tasks",
+            "events": event["events"],
+        }))
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from api.models import Conversation, Message, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares queries per chat message for the old save path (two User "
+        "lookups plus INSERT) and the current one (INSERT with known ids). "
+        "Both also write the two inbox summary statements (ConversationSummary."
+        "record). Runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = options["messages"]
+
+        with transaction.atomic():
+            sender = User.objects.create(username="bench-sender", email="bench-sender@example.com")
+            receiver = User.objects.create(username="bench-receiver", email="bench-receiver@example.com")
+            conversation = Conversation.between(sender.id, receiver.id)
+
+            def lookup_per_message(i):
+                sender_obj = User.objects.get(id=sender.id)
+                receiver_obj = User.objects.get(id=receiver.id)
+                Message.objects.create(
+                    conversation=conversation, user=sender_obj, sender=sender_obj, receiver=receiver_obj,
+                    message=f"before {i}",
+                )
+
+            def ids_from_connection(i):
+                Message.objects.create(
+                    conversation=conversation, user_id=sender.id, sender_id=sender.id, receiver_id=receiver.id,
+                    message=f"after {i}",
+                )
+
+            for label, save in (("before", lookup_per_message), ("after", ids_from_connection)):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    for i in range(count):
+                        save(i)
+                    elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"{label:>6}: {len(queries) / count:.2f} queries/message, "
+                    f"{elapsed / count * 1000:.3f} ms/message"
+                )
+
+            transaction.set_rollback(True)
@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from api.models import User
+from api.serializer import RegisterSerializer
+
+
+class DoubleSaveRegisterSerializer(RegisterSerializer):
+    """
+    The previous registration path: INSERT, then a second full save for the
+    password, with the removed ``save_profile`` signal saving the profile
+    again after each of them.
+    """
+
+    def create(self, validated_data):
+        user = User.objects.create(username=validated_data['username'], email=validated_data['email'])
+        user.profile.save()
+        user.set_password(validated_data['password'])
+        user.save()
+        user.profile.save()
+        return user
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares queries, writes and throughput per registration for the "
+        "previous double-save path and the current RegisterSerializer. Runs "
+        "inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument(
+            "--real-hasher", action="store_true",
+            help="Hash passwords with the configured hasher instead of MD5; "
+                 "hashing then dominates the timings.",
+        )
+
+    def handle(self, *args, **options):
+        count = options["users"]
+        hashers = {} if options["real_hasher"] else {
+            "PASSWORD_HASHERS": ["django.contrib.auth.hashers.MD5PasswordHasher"],
+        }
+
+        with override_settings(**hashers), transaction.atomic():
+            for label, serializer_class in (("before", DoubleSaveRegisterSerializer), ("after", RegisterSerializer)):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    for i in range(count):
+                        register = serializer_class(data={
+                            "username": f"bench-{label}-{i}",
+                            "email": f"bench-{label}-{i}@example.com",
+                            "password": "bench-Passw0rd!",
+                            "password2": "bench-Passw0rd!",
+                        })
+                        register.is_valid(raise_exception=True)
+                        register.save()
+                    elapsed = time.perf_counter() - started
+                writes = sum(
+                    1 for query in queries
+                    if query["sql"].lstrip().upper().startswith(("INSERT", "UPDATE"))
+                )
+                self.stdout.write(
+                    f"{label:>6}: {len(queries) / count:.2f} queries/registration, "
+                    f"{writes / count:.2f} writes/registration, {count / elapsed:.1f} registrations/s"
+                )
+
+            transaction.set_rollback(True)
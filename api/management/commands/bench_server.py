@@ -0,0 +1,200 @@
+import asyncio
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+from websockets.asyncio.client import connect
+
+from api.middleware import TOKEN_SUBPROTOCOL
+from api.models import User
+from api.serialization import dumps, loads
+
+USERNAME_PREFIX = "bench-server-"
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def read_response(reader):
+    """
+    Reads one HTTP/1.1 response and returns ``(status, keep_alive)``.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by the server")
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+
+    return status, headers.get("connection", "").lower() != "close"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test for a running server (gunicorn.conf.py): HTTP requests over "
+        "keep-alive connections, then chat protocol 2 round trips (message to "
+        "ack) over WebSockets, each for --duration seconds. Reports throughput "
+        "and latency percentiles. The bench-server-* users it authenticates as "
+        "are created in the configured database, which must be the server's."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument("--mode", choices=["both", "http", "ws"], default="both")
+        parser.add_argument("--duration", type=float, default=10)
+        parser.add_argument("--users", type=int, default=20,
+                            help="Users to authenticate as; also the number of WebSocket connections.")
+        parser.add_argument("--http-connections", type=int, default=50)
+        parser.add_argument("--http-path", default="/api/profile/")
+        parser.add_argument("--cleanup", action="store_true",
+                            help="Delete the bench-server-* users (and their messages) afterwards.")
+
+    def handle(self, *args, **options):
+        url = urlsplit(options["url"])
+        if url.scheme != "http" or not url.hostname:
+            raise CommandError("--url must be http://host[:port]")
+        if options["users"] < 2:
+            raise CommandError("--users must be at least 2.")
+
+        users = self.bench_users(options["users"])
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        try:
+            if options["mode"] in ("both", "http"):
+                asyncio.run(self.run_http(url, tokens, options))
+            if options["mode"] in ("both", "ws"):
+                asyncio.run(self.run_ws(url, users, tokens, options))
+        finally:
+            if options["cleanup"]:
+                User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+    def bench_users(self, count):
+        users = []
+        for i in range(count):
+            user, created = User.objects.get_or_create(
+                username=f"{USERNAME_PREFIX}{i}", defaults={"email": f"{USERNAME_PREFIX}{i}@example.com"},
+            )
+            if created:
+                user.set_unusable_password()
+                user.save(update_fields=["password"])
+            users.append(user)
+        return users
+
+    def report(self, label, count, elapsed, latencies, outcomes):
+        self.stdout.write(
+            f"{label}: {count} in {elapsed:.1f}s = {count / elapsed:.1f}/s, latency "
+            f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms"
+        )
+        self.stdout.write("  " + ", ".join(f"{outcome}: {n}" for outcome, n in sorted(outcomes.items())))
+
+    async def run_http(self, url, tokens, options):
+        port = url.port or 80
+        deadline = time.perf_counter() + options["duration"]
+        latencies, outcomes = [], Counter()
+
+        async def client(token):
+            request = (
+                f"GET {options['http_path']} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                f"Authorization: Bearer {token}\r\nAccept: application/json\r\n\r\n"
+            ).encode()
+            writer = None
+            while time.perf_counter() < deadline:
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.open_connection(url.hostname, port)
+                    started = time.perf_counter()
+                    writer.write(request)
+                    status, keep_alive = await read_response(reader)
+                    latencies.append(time.perf_counter() - started)
+                    outcomes[status] += 1
+                except (OSError, asyncio.IncompleteReadError, ValueError) as exc:
+                    outcomes[type(exc).__name__] += 1
+                    keep_alive = False
+                if not keep_alive and writer is not None:
+                    writer.close()
+                    writer = None
+            if writer is not None:
+                writer.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            client(tokens[i % len(tokens)]) for i in range(options["http_connections"])
+        ))
+        self.report(
+            f"HTTP GET {options['http_path']} ({options['http_connections']} connections)",
+            len(latencies), time.perf_counter() - started, latencies, outcomes,
+        )
+
+    async def run_ws(self, url, users, tokens, options):
+        base = f"ws://{url.netloc}"
+        run = uuid.uuid4().hex[:8]
+        deadline = time.perf_counter() + options["duration"]
+        connect_times, latencies, outcomes = [], [], Counter()
+
+        async def client(i):
+            # users chat in pairs: 0 with 1, 2 with 3, ...
+            peer = users[i ^ 1] if (i ^ 1) < len(users) else users[0]
+            path = f"{base}/ws/chat/{users[i].id}/{peer.id}/?protocol=2"
+            started = time.perf_counter()
+            try:
+                socket = await connect(path, subprotocols=[TOKEN_SUBPROTOCOL, tokens[i]])
+            except Exception as exc:
+                outcomes[f"connect {type(exc).__name__}"] += 1
+                return
+            connect_times.append(time.perf_counter() - started)
+
+            sent = 0
+            async with socket:
+                while time.perf_counter() < deadline:
+                    client_id = f"{run}-{i}-{sent}"
+                    started = time.perf_counter()
+                    await socket.send(dumps({"type": "message", "client_id": client_id, "message": f"load test {sent}"}))
+                    sent += 1
+                    status = None
+                    while status is None:
+                        try:
+                            frame = loads(await socket.recv())
+                        except Exception as exc:
+                            outcomes[type(exc).__name__] += 1
+                            return
+                        for item in frame if isinstance(frame, list) else [frame]:
+                            if item.get("type") == "ack" and item.get("client_id") == client_id:
+                                status = item["status"]
+                    latencies.append(time.perf_counter() - started)
+                    outcomes[status] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(len(users))))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"WebSocket connect ({len(connect_times)} of {len(users)}): "
+            f"p50 {percentile(connect_times, 0.5) * 1000:.1f} ms, "
+            f"p99 {percentile(connect_times, 0.99) * 1000:.1f} ms"
+        )
+        self.report(
+            f"WebSocket chat message to ack ({len(users)} connections)",
+            len(latencies), elapsed, latencies, outcomes,
+        )
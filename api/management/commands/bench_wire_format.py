@@ -0,0 +1,91 @@
+import json
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import serialization
+
+
+def chat_message(i):
+    return {
+        "type": "chat_message",
+        "message": {
+            "uid": str(uuid.uuid4()),
+            "conversation": 42,
+            "sender": 1001,
+            "receiver": 1002,
+            "message": f"see you at {i % 24}:00, bring the slides",
+            "date": "2026-10-18 12:00:00",
+            "client_id": f"c-{i}",
+        },
+    }
+
+
+def online_user(i):
+    return {"user_id": 1000 + i, "user__username": f"user{i}", "name": f"User Number {i}", "is_online": True}
+
+
+PAYLOADS = {
+    "chat_message": lambda: chat_message(0),
+    "chat batch (v2, 50)": lambda: [chat_message(i) for i in range(50)],
+    "presence delta (20)": lambda: {
+        "type": "presence", "seq": 1234, "joined": [online_user(i) for i in range(10)], "left": list(range(10)),
+    },
+    "snapshot (200)": lambda: {"type": "online_users", "seq": 1234, "data": [online_user(i) for i in range(200)]},
+}
+
+
+def deflate(data):
+    """
+    ``data`` as one permessage-deflate message with the WS_COMPRESSION_*
+    settings (backend/websocket.py). A fresh compressor per message, so
+    this is the worst case; connections keep their context between messages.
+    """
+    compressor = zlib.compressobj(
+        settings.WS_COMPRESSION_LEVEL, zlib.DEFLATED, -settings.WS_COMPRESSION_WINDOW_BITS,
+        settings.WS_COMPRESSION_MEM_LEVEL,
+    )
+    return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares bytes on the wire and encode time per frame for the WebSocket "
+        "encodings: stdlib JSON, the configured JSON path (orjson when installed), "
+        "MessagePack with compact keys, and that JSON with permessage-deflate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if serialization.msgpack is None:
+            raise CommandError("msgpack is not installed.")
+
+        iterations = options["iterations"]
+        json_label = "orjson" if serialization.orjson is not None else "json (fallback)"
+        encoders = (
+            ("stdlib json", lambda obj: json.dumps(obj).encode()),
+            (json_label, serialization.dumps_bytes),
+            ("msgpack", serialization.pack),
+            (json_label + " + deflate", lambda obj: deflate(serialization.dumps_bytes(obj))),
+        )
+
+        for name, build in PAYLOADS.items():
+            payload = build()
+            self.stdout.write(name)
+            baseline = None
+            for label, encode in encoders:
+                size = len(encode(payload))
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    encode(payload)
+                elapsed = time.perf_counter() - started
+                baseline = baseline or size
+                self.stdout.write(
+                    f"  {label:>16}: {size:>7} bytes ({size / baseline:5.0%}), "
+                    f"{elapsed / iterations * 1e6:8.1f} us/encode"
+                )
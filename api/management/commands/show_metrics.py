@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api import metrics
+
+
+class Command(BaseCommand):
+    help = "Prints the counters collected in Redis by the realtime subsystems."
+
+    def add_arguments(self, parser):
+        parser.add_argument("namespace", nargs="*", help="Namespaces to print (default: all).")
+
+    def handle(self, *args, **options):
+        for namespace in options["namespace"] or metrics.namespaces():
+            self.stdout.write(f"[{namespace}]")
+            for name, value in sorted(metrics.get(namespace).items()):
+                self.stdout.write(f"  {name}: {value}")
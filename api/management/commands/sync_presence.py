@@ -0,0 +1,45 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api import online_tracker, presence
+
+
+class Command(BaseCommand):
+    help = "Periodically writes presence changes from Redis back to Profile.is_online."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=settings.PRESENCE_SYNC_INTERVAL,
+            help="Seconds between sync passes.",
+        )
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Run a single sync pass and exit.",
+        )
+
+    def handle(self, *args, **options):
+        # ghosts left by a crash are expired (and announced) before the
+        # profiles are reconciled with Redis
+        self.expire()
+        online_tracker.reconcile_profiles()
+
+        while True:
+            self.expire()
+            online, offline = online_tracker.sync_profiles()
+            if online or offline:
+                self.stdout.write(f"presence sync: {len(online)} online, {len(offline)} offline")
+
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
+
+    def expire(self):
+        """
+        Drops connections that stopped sending heartbeats and tells the
+        contacts of every user that went offline with them.
+        """
+        expired = online_tracker.expire_stale_connections()
+        if expired:
+            presence.send_left(expired)
@@ -0,0 +1,51 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections
+
+from api import message_queue, metrics
+
+
+class Command(BaseCommand):
+    help = "Writes queued chat messages to the database in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.CHAT_WRITE_BATCH_SIZE,
+            help="Maximum messages per INSERT.",
+        )
+        parser.add_argument(
+            "--interval", type=float, default=settings.CHAT_WRITE_INTERVAL,
+            help="Seconds to wait when the queue holds less than a full batch.",
+        )
+
+    def handle(self, *args, **options):
+        writer = message_queue.new_writer()
+        recovered = message_queue.recover(writer)
+        if recovered:
+            self.stdout.write(f"recovered {recovered} messages from unfinished batches")
+
+        unfinished = False
+        last_recovery = time.monotonic()
+        while True:
+            message_queue.beat(writer)
+            try:
+                if unfinished or time.monotonic() - last_recovery > settings.CHAT_WRITER_TTL:
+                    # the batch that failed is still in the processing list;
+                    # writers that stopped meanwhile may have left one too
+                    recovered = message_queue.recover(writer)
+                    if recovered:
+                        self.stdout.write(f"recovered {recovered} messages from unfinished batches")
+                    unfinished = False
+                    last_recovery = time.monotonic()
+                written = message_queue.flush(options["batch_size"], writer)
+            except DatabaseError as exc:
+                unfinished = True
+                self.stderr.write(f"database write failed, retrying: {exc}")
+                connections.close_all()
+                time.sleep(options["interval"])
+                continue
+            metrics.gauge("chat_writer", backlog=message_queue.backlog())
+            if written < options["batch_size"]:
+                time.sleep(options["interval"])
@@ -0,0 +1,263 @@
+import logging
+import uuid
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+
+from api import metrics, online_tracker
+from api.models import ConversationSummary, Message
+from api.online_tracker import redis_client
+from api.serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Chat messages waiting to be written to the database
+QUEUE_KEY = "chat:write_queue"
+# Batch taken by a writer and not yet committed, one list per writer;
+# replayed by the writer itself or, once it stopped, by another one
+PROCESSING_KEY = "chat:write_processing:"
+# ids of the writers that may have a processing list
+WRITERS_KEY = "chat:writers"
+# set by every running writer, expires CHAT_WRITER_TTL seconds after its last beat
+WRITER_ALIVE_KEY = "chat:writer_alive:"
+# uids of client-identified messages already accepted, to drop retries
+SEEN_KEY = "chat:seen:"
+# uuid5 namespace turning (sender, client_id) into a stable message uid
+CLIENT_ID_NAMESPACE = uuid.UUID("0c3b5f8e-4d1a-4f6e-9a57-2f1d8c7b6e40")
+
+
+# Moves up to ARGV[1] entries from the queue to the processing list.
+_take_batch = redis_client.register_script("""
+local entries = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #entries > 0 then
+    redis.call('LTRIM', KEYS[1], #entries, -1)
+    redis.call('RPUSH', KEYS[2], unpack(entries))
+end
+return entries
+""")
+
+
+# Moves the processing list (KEYS[3]) of writer ARGV[1] to KEYS[4] and
+# forgets the writer, unless it is still alive (KEYS[2]).
+_claim_batch = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return -1
+end
+local entries = redis.call('LRANGE', KEYS[3], 0, -1)
+if #entries > 0 then
+    redis.call('RPUSH', KEYS[4], unpack(entries))
+end
+redis.call('DEL', KEYS[3])
+redis.call('SREM', KEYS[1], ARGV[1])
+return #entries
+""")
+
+
+# Queues the entries (ARGV[2..]) whose seen key (KEYS[2..]) was not set
+# yet, setting it for ARGV[1] seconds, and returns their positions.
+_enqueue_unseen = redis_client.register_script("""
+local queued = {}
+for i = 2, #KEYS do
+    if redis.call('SET', KEYS[i], 1, 'NX', 'EX', ARGV[1]) then
+        redis.call('RPUSH', KEYS[1], ARGV[i])
+        table.insert(queued, i - 1)
+    end
+end
+return queued
+""")
+
+
+def client_uid(sender_id, client_id):
+    """
+    The uid a message with a client-generated id is stored under. The same
+    id sent twice by the same user maps to the same uid, which is unique
+    in the database.
+    """
+    return str(uuid.uuid5(CLIENT_ID_NAMESPACE, f"{sender_id}:{client_id}"))
+
+
+def new_entry(conversation_id, sender_id, receiver_id, text, uid=None):
+    return {
+        "uid": uid or str(uuid.uuid4()),
+        "conversation": conversation_id,
+        "sender": sender_id,
+        "receiver": receiver_id,
+        "message": text,
+        "date": timezone.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def enqueue(conversation_id, sender_id, receiver_id, text):
+    """
+    Queues a chat message for the batch writer and returns it with the
+    server-assigned ``uid`` it will be stored under.
+
+    A message counts as accepted once it is in Redis, so durability is
+    that of the Redis instance (enable AOF in production).
+    """
+    entry = new_entry(conversation_id, sender_id, receiver_id, text)
+    redis_client.rpush(QUEUE_KEY, dumps(entry))
+    return entry
+
+
+def enqueue_unseen(entries, ttl):
+    """
+    Queues, in one round trip, the entries whose ``uid`` was not accepted
+    in the last ``ttl`` seconds and returns them; the others are retries.
+    """
+    if not entries:
+        return []
+    positions = _enqueue_unseen(
+        keys=[QUEUE_KEY] + [SEEN_KEY + entry["uid"] for entry in entries],
+        args=[ttl] + [dumps(entry) for entry in entries],
+    )
+    return [entries[position - 1] for position in positions]
+
+
+def enqueue_read(user_id, conversation_id, up_to_uid):
+    """
+    Queues a read marker behind the messages already queued. The writer
+    applies it once everything before it is stored, so marking a message
+    that is still in the queue by its ``uid`` works.
+    """
+    redis_client.rpush(QUEUE_KEY, dumps({
+        "read": {"user": user_id, "conversation": conversation_id, "up_to_uid": up_to_uid},
+    }))
+
+
+def backlog():
+    writers = redis_client.smembers(WRITERS_KEY)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.llen(QUEUE_KEY)
+    for writer in writers:
+        pipe.llen(PROCESSING_KEY + writer.decode())
+    return sum(pipe.execute())
+
+
+def new_writer():
+    """
+    Registers a writer process and returns its id. Every writer moves
+    batches through its own processing list, so several can run at once.
+    """
+    writer = uuid.uuid4().hex
+    redis_client.sadd(WRITERS_KEY, writer)
+    beat(writer)
+    return writer
+
+
+def beat(writer):
+    """
+    Keeps the writer's processing list its own for another
+    ``CHAT_WRITER_TTL`` seconds; after that ``recover`` of another writer
+    takes it over.
+    """
+    redis_client.set(WRITER_ALIVE_KEY + writer, 1, ex=settings.CHAT_WRITER_TTL)
+
+
+def flush(batch_size, writer):
+    """
+    Writes up to ``batch_size`` queued messages with one bulk INSERT and
+    returns how many were taken from the queue.
+    """
+    key = PROCESSING_KEY + writer
+    entries = _take_batch(keys=[QUEUE_KEY, key], args=[batch_size])
+    if entries:
+        write([loads(entry) for entry in entries])
+        redis_client.delete(key)
+    return len(entries)
+
+
+def recover(writer):
+    """
+    Writes the batch the writer failed to commit, together with those left
+    by writers that stopped beating (crashed or scaled down). Entries are
+    keyed by ``uid`` and ones already stored are skipped, so replaying a
+    committed batch is harmless.
+    """
+    key = PROCESSING_KEY + writer
+    for other in redis_client.smembers(WRITERS_KEY):
+        other = other.decode()
+        if other != writer:
+            _claim_batch(
+                keys=[WRITERS_KEY, WRITER_ALIVE_KEY + other, PROCESSING_KEY + other, key],
+                args=[other],
+            )
+
+    entries = redis_client.lrange(key, 0, -1)
+    if entries:
+        write([loads(entry) for entry in entries])
+        redis_client.delete(key)
+    return len(entries)
+
+
+def store(entries):
+    """
+    Inserts the entries not yet in the database and updates the inbox
+    summaries for them in the same transaction. Returns the uids that were
+    already stored and the messages written; the other entries were
+    dropped.
+    """
+    existing = {
+        str(uid) for uid in
+        Message.objects.filter(uid__in=[entry["uid"] for entry in entries]).values_list('uid', flat=True)
+    }
+    messages = [
+        Message(
+            uid=entry["uid"],
+            conversation_id=entry["conversation"],
+            user_id=entry["sender"],
+            sender_id=entry["sender"],
+            receiver_id=entry["receiver"],
+            message=entry["message"],
+        )
+        for entry in entries
+        if entry["uid"] not in existing
+    ]
+
+    # Only errors caused by the rows themselves are handled here. Others
+    # (the database being unreachable, ...) propagate and leave the batch
+    # in the processing list for the writer to retry.
+    written = []
+    try:
+        with transaction.atomic():
+            written = Message.objects.bulk_create(messages)
+            ConversationSummary.record(written)
+    except (IntegrityError, DataError):
+        # one bad row (e.g. an unknown receiver) must not block the queue
+        written = []
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+                    ConversationSummary.record([message])
+                written.append(message)
+            except (IntegrityError, DataError):
+                logger.exception("Dropping chat message %s", message.uid)
+
+    return existing, written
+
+
+def write(entries):
+    """
+    Stores a batch taken from the queue, records the new contacts and then
+    applies the read markers of the batch.
+    """
+    reads = [entry["read"] for entry in entries if "read" in entry]
+    entries = [entry for entry in entries if "read" not in entry]
+    existing, written = store(entries)
+    duplicates = sum(entry["uid"] in existing for entry in entries)
+
+    for pair in {(message.sender_id, message.receiver_id) for message in written}:
+        online_tracker.add_contact(*pair)
+
+    metrics.incr(
+        "chat_writer",
+        written=len(written),
+        duplicates=duplicates,
+        dropped=len(entries) - duplicates - len(written),
+        batches=1,
+    )
+
+    for read in reads:
+        ConversationSummary.mark_read(read["user"], read["conversation"], up_to_uid=read["up_to_uid"])
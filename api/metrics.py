@@ -0,0 +1,32 @@
+from api.online_tracker import redis_client
+
+METRICS_KEY = "metrics:"
+
+
+def incr(namespace, **counts):
+    """
+    Adds the given counts to a Redis hash shared by every worker, e.g.
+    ``incr("presence", events=10, merged=7)``.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for name, value in counts.items():
+        pipe.hincrby(METRICS_KEY + namespace, name, value)
+    pipe.execute()
+
+
+def gauge(namespace, **values):
+    """
+    Stores gauges such as queue lengths next to the counters.
+    """
+    redis_client.hset(METRICS_KEY + namespace, mapping=values)
+
+
+def get(namespace):
+    return {
+        name.decode(): int(value)
+        for name, value in redis_client.hgetall(METRICS_KEY + namespace).items()
+    }
+
+
+def namespaces():
+    return sorted(key.decode()[len(METRICS_KEY):] for key in redis_client.scan_iter(METRICS_KEY + "*"))
@@ -0,0 +1,44 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+
+from api.authentication import user_from_token
+
+# Browsers cannot set headers on a WebSocket, so the token is sent as the
+# subprotocol pair ``["access_token", "<jwt>"]`` (preferred) or as
+# ``?token=<jwt>``. The query string ends up in server and proxy access
+# logs; backend/workers.py masks it in ours.
+TOKEN_SUBPROTOCOL = "access_token"
+
+
+def token_from_scope(scope):
+    """
+    ``(token, subprotocol)`` of a connection. ``subprotocol`` is the one the
+    server has to accept with when the token came as a subprotocol.
+    """
+    subprotocols = scope.get("subprotocols") or []
+    if TOKEN_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(TOKEN_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1], TOKEN_SUBPROTOCOL
+
+    tokens = parse_qs(scope.get("query_string", b"").decode()).get("token")
+    return (tokens[0] if tokens else None), None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets ``scope["user"]`` from a SimpleJWT access token, replacing the
+    session lookup of ``AuthMiddlewareStack``. Invalid or expired tokens
+    give ``AnonymousUser``, which the consumers close. Consumers accept
+    with ``scope["auth_subprotocol"]``.
+    """
+
+    async def __call__(self, scope, receive, send):
+        token, subprotocol = token_from_scope(scope)
+        scope = dict(scope)
+        scope["user"] = await database_sync_to_async(user_from_token)(token) if token else AnonymousUser()
+        scope["auth_subprotocol"] = subprotocol
+        return await super().__call__(scope, receive, send)
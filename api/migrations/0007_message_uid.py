@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-18 09:12
+
+import uuid
+
+from django.db import migrations, models
+
+
+def gen_uid(apps, schema_editor):
+    Message = apps.get_model('api', 'Message')
+    for message in Message.objects.only('id'):
+        message.uid = uuid.uuid4()
+        message.save(update_fields=['uid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_alter_profile_date_of_birth_alter_profile_gender_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, null=True),
+        ),
+        migrations.RunPython(gen_uid, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
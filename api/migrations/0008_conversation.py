@@ -0,0 +1,49 @@
+# Generated by Django 5.1.6 on 2026-10-18 09:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_conversations(apps, schema_editor):
+    Conversation = apps.get_model('api', 'Conversation')
+    Message = apps.get_model('api', 'Message')
+    pairs = Message.objects.order_by().values_list('sender_id', 'receiver_id').distinct()
+    for user_low_id, user_high_id in {tuple(sorted(pair)) for pair in pairs}:
+        conversation, _ = Conversation.objects.get_or_create(user_low_id=user_low_id, user_high_id=user_high_id)
+        Message.objects.filter(
+            sender_id__in=[user_low_id, user_high_id],
+            receiver_id__in=[user_low_id, user_high_id],
+        ).update(conversation=conversation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_message_uid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='api.conversation'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_conversation_pair'),
+        ),
+        # the column becomes NOT NULL in 0009, in its own transaction:
+        # PostgreSQL cannot ALTER a table with pending (deferred) FK trigger
+        # events from the UPDATEs below
+        migrations.RunPython(fill_conversations, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 10:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_conversation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='api.conversation'),
+        ),
+    ]
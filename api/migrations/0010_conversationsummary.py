@@ -0,0 +1,46 @@
+# Generated by Django 5.1.6 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_summaries(apps, schema_editor):
+    Conversation = apps.get_model('api', 'Conversation')
+    ConversationSummary = apps.get_model('api', 'ConversationSummary')
+    for conversation in Conversation.objects.all():
+        last = conversation.messages.order_by('-id').first()
+        for user_id in {conversation.user_low_id, conversation.user_high_id}:
+            ConversationSummary.objects.create(
+                conversation=conversation,
+                user_id=user_id,
+                last_message=last,
+                last_message_at=last.date if last else None,
+                unread_count=conversation.messages.filter(receiver_id=user_id, is_read=False).count(),
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_message_conversation_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='api.conversation')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.message')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_message_at'], name='summary_inbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'conversation'), name='unique_summary_participant')],
+            },
+        ),
+        migrations.RunPython(fill_summaries, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:02
+
+from django.db import migrations
+
+
+POSTGRESQL_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # icontains compiles to UPPER(column) LIKE UPPER(%s), so index the same expression
+    "CREATE INDEX IF NOT EXISTS api_user_username_trgm ON api_user USING gin (UPPER(username) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS api_user_email_trgm ON api_user USING gin (UPPER(email) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS api_profile_name_trgm ON api_profile USING gin (UPPER(name) gin_trgm_ops)",
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS api_user_username_trgm",
+    "DROP INDEX IF EXISTS api_user_email_trgm",
+    "DROP INDEX IF EXISTS api_profile_name_trgm",
+]
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE api_profile_search USING fts5(username, name, email, tokenize='trigram')",
+    """
+    INSERT INTO api_profile_search (rowid, username, name, email)
+    SELECT profile.id, user.username, profile.name, user.email
+    FROM api_profile AS profile JOIN api_user AS user ON user.id = profile.user_id
+    """,
+    """
+    CREATE TRIGGER api_profile_search_insert AFTER INSERT ON api_profile BEGIN
+        INSERT INTO api_profile_search (rowid, username, name, email)
+        SELECT new.id, username, new.name, email FROM api_user WHERE id = new.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER api_profile_search_update AFTER UPDATE ON api_profile BEGIN
+        DELETE FROM api_profile_search WHERE rowid = old.id;
+        INSERT INTO api_profile_search (rowid, username, name, email)
+        SELECT new.id, username, new.name, email FROM api_user WHERE id = new.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER api_profile_search_delete AFTER DELETE ON api_profile BEGIN
+        DELETE FROM api_profile_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER api_user_search_update AFTER UPDATE OF username, email ON api_user BEGIN
+        UPDATE api_profile_search SET username = new.username, email = new.email
+        WHERE rowid IN (SELECT id FROM api_profile WHERE user_id = new.id);
+    END
+    """,
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS api_user_search_update",
+    "DROP TRIGGER IF EXISTS api_profile_search_delete",
+    "DROP TRIGGER IF EXISTS api_profile_search_update",
+    "DROP TRIGGER IF EXISTS api_profile_search_insert",
+    "DROP TABLE IF EXISTS api_profile_search",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRESQL_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            reverse_code=run({'postgresql': POSTGRESQL_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
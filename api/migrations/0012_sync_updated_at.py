@@ -0,0 +1,53 @@
+# Generated by Django 5.1.6 on 2026-10-18 16:40
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_updated_at(apps, schema_editor):
+    for model in ('Task', 'Message'):
+        apps.get_model('api', model).objects.update(updated_at=F('date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_profile_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='updated_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fill_updated_at, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='task',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='task_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'updated_at', 'id'], name='message_sync_idx'),
+        ),
+    ]
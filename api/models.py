@@ -1,6 +1,12 @@
-from django.db import models
+import uuid
+
+from django.db import models, transaction
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractUser
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from api.cache import invalidate_profile, invalidate_user
 
 GENDER = {
     'Male': 'M',
@@ -38,15 +44,56 @@ class Profile(models.Model):
         super(Profile, self).save(*args, **kwargs)
 
 def create_profile(sender, instance, created, **kwargs):
+    # the name is passed so Profile.save does not load the user again
     if created:
-        Profile.objects.create(user=instance)
+        Profile.objects.create(user=instance, name=instance.username)
+
+
+def invalidate_cached_profile(sender, instance, **kwargs):
+    user_id = instance.pk if sender is User else instance.user_id
+    # after commit, so a concurrent read cannot cache the old row under the new version
+    transaction.on_commit(lambda: invalidate_profile(user_id))
 
 
-def save_profile(sender, instance, **kwargs):
-    instance.profile.save()
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_user(user_id))
+
+
+def invalidate_blacklisted_user(sender, instance, created, **kwargs):
+    # logging out blacklists the refresh token; stop serving the cached user
+    if created:
+        user_id = instance.token.user_id
+        transaction.on_commit(lambda: invalidate_user(user_id))
 
 post_save.connect(create_profile, sender=User)
-post_save.connect(save_profile, sender=User)
+post_save.connect(invalidate_cached_profile, sender=User)
+post_save.connect(invalidate_cached_profile, sender=Profile)
+post_delete.connect(invalidate_cached_profile, sender=Profile)
+post_save.connect(invalidate_cached_user, sender=User)
+post_delete.connect(invalidate_cached_user, sender=User)
+post_save.connect(invalidate_blacklisted_user, sender='token_blacklist.BlacklistedToken')
+
+
+class TaskQuerySet(models.QuerySet):
+    def delete(self):
+        """
+        Turns the tasks into tombstones like ``Task.delete()``, so bulk
+        deletes (``Task.objects.filter(...).delete()``, the admin's "delete
+        selected") reach syncing clients too. ``Task.all_objects`` keeps
+        Django's delete, which removes rows for good.
+        """
+        now = timezone.now()
+        count = self.filter(deleted_at__isnull=True).update(deleted_at=now, updated_at=now)
+        return count, {self.model._meta.label: count}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class LiveTaskManager(models.Manager.from_queryset(TaskQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
 
 
 class Task(models.Model):
@@ -54,33 +101,263 @@ class Task(models.Model):
     title = models.CharField(max_length=1000, null=False)
     completed = models.BooleanField(default=False)
     date = models.DateTimeField(auto_now_add=True)
+    # sync cursor; update() and bulk_update() must set it explicitly
+    updated_at = models.DateTimeField(auto_now=True)
+    # deleted tasks are kept as tombstones so syncing clients learn about them
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = LiveTaskManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'updated_at', 'id'], name='task_sync_idx'),
+        ]
 
     def __str__(self):
         return self.title[:30]
-    
+
+    def delete(self, using=None, keep_parents=False):
+        # updated_at is set by auto_now
+        self.deleted_at = timezone.now()
+        self.save(using=using, update_fields=['deleted_at', 'updated_at'])
+        return 1, {self._meta.label: 1}
+
+    @classmethod
+    def apply_batch(cls, user_id, operations):
+        """
+        Applies validated ``(index, operation)`` pairs of one user in a
+        single transaction: one SELECT for the referenced tasks, then one
+        ``bulk_create``, one ``bulk_update`` and one UPDATE that turns the
+        deleted tasks into tombstones. Operations run in order, so a task
+        deleted earlier in the batch is not found by later ones. Returns ``(index, op, status, task_or_id)`` per operation.
+        """
+        ids = {operation['id'] for _, operation in operations if operation['op'] != 'create'}
+        results = []
+        created, changed, deleted = [], {}, {}
+
+        with transaction.atomic():
+            tasks = cls.objects.select_for_update().filter(user_id=user_id).in_bulk(ids)
+
+            for index, operation in operations:
+                op = operation['op']
+                if op == 'create':
+                    task = cls(user_id=user_id, title=operation['title'], completed=operation.get('completed', False))
+                    created.append(task)
+                    results.append((index, op, 'created', task))
+                    continue
+
+                task = tasks.get(operation['id'])
+                if task is None or task.id in deleted:
+                    results.append((index, op, 'not_found', operation['id']))
+                    continue
+
+                if op == 'delete':
+                    # earlier changes stay in bulk_update, so the tombstone
+                    # holds what the batch reported
+                    deleted[task.id] = task
+                    results.append((index, op, 'deleted', task))
+                    continue
+
+                if op == 'complete':
+                    task.completed = True
+                else:
+                    for field in ('title', 'completed'):
+                        if field in operation:
+                            setattr(task, field, operation[field])
+                changed[task.id] = task
+                results.append((index, op, 'updated', task))
+
+            if created:
+                cls.objects.bulk_create(created)
+            now = timezone.now()
+            if changed:
+                for task in changed.values():
+                    task.updated_at = now
+                cls.objects.bulk_update(changed.values(), ['title', 'completed', 'updated_at'])
+            if deleted:
+                for task in deleted.values():
+                    task.deleted_at = task.updated_at = now
+                cls.objects.filter(id__in=deleted).update(deleted_at=now, updated_at=now)
+
+        return results
+
+
+class Conversation(models.Model):
+    """
+    One row per pair of users, stored with the smaller id first so both
+    directions of a chat resolve to the same conversation.
+    """
+    user_low = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_conversation_pair'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_low_id} - {self.user_high_id}"
+
+    @property
+    def group_name(self):
+        return f"chat_{self.user_low_id}_{self.user_high_id}"
+
+    def other_user_id(self, user_id):
+        return self.user_high_id if self.user_low_id == user_id else self.user_low_id
+
+    @classmethod
+    def between(cls, user_id, other_id):
+        user_low_id, user_high_id = sorted((int(user_id), int(other_id)))
+        conversation, _ = cls.objects.get_or_create(user_low_id=user_low_id, user_high_id=user_high_id)
+        return conversation
+
+
 class Message(models.Model):
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    # indexed together with id in Meta.indexes
+    conversation = models.ForeignKey(Conversation, related_name="messages", on_delete=models.CASCADE, db_index=False)
     user = models.ForeignKey(User, related_name="user", on_delete=models.CASCADE)
     sender = models.ForeignKey(User, related_name="sender", on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name="receiver", on_delete=models.CASCADE)
     message = models.CharField(max_length=500)
     is_read = models.BooleanField(default=False)
     date = models.DateTimeField(auto_now_add=True)
+    # sync cursor; update() and bulk_update() must set it explicitly. Messages
+    # are never deleted (see MessageAdmin), so they need no tombstones.
+    updated_at = models.DateTimeField(auto_now=True)
 
 
     class Meta:
         ordering = ['date']
+        indexes = [
+            models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+            models.Index(fields=['conversation', 'updated_at', 'id'], name='message_sync_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender} - {self.receiver} - {self.message[:20]} - {self.date}"
 
+    def save(self, *args, **kwargs):
+        if self.conversation_id is None:
+            self.conversation = Conversation.between(self.sender_id, self.receiver_id)
+        created = self._state.adding
+        # the inbox summaries commit or roll back together with the message;
+        # bulk_create() callers (api.message_queue) record them per batch
+        with transaction.atomic(savepoint=False):
+            super(Message, self).save(*args, **kwargs)
+            if created:
+                ConversationSummary.record([self])
+
 
+    # use select_related('sender__profile', 'receiver__profile') when
+    # serializing many messages, otherwise each property costs a query
     @property
     def sender_profile(self):
-        sender_profile = Profile.objects.get(user=self.sender)
-        return sender_profile
+        return self.sender.profile
 
     @property
     def receiver_profile(self):
-        receiver_profile = Profile.objects.get(user=self.receiver)
-        return receiver_profile 
-        
\ No newline at end of file
+        return self.receiver.profile
+        
+
+class ConversationSummary(models.Model):
+    """
+    Inbox row of one participant of a conversation. Kept up to date when
+    messages are stored so the inbox is a single range scan on
+    (user, last_message_at).
+    """
+    conversation = models.ForeignKey(Conversation, related_name="summaries", on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE, db_index=False)
+    last_message = models.ForeignKey(Message, related_name="+", on_delete=models.SET_NULL, null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='unique_summary_participant'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at'], name='summary_inbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.conversation} - {self.unread_count}"
+
+    @classmethod
+    def record(cls, messages):
+        """
+        Updates the summaries of both participants for newly stored
+        messages: the last message moves forward and the receiver's
+        unread count grows. Works on whole batches from the chat writer:
+        one INSERT for missing summaries and one UPDATE per conversation.
+        Call it in the transaction that stores the messages.
+        """
+        conversations = {}
+        for message in messages:
+            conversations.setdefault(message.conversation_id, []).append(message)
+        if not conversations:
+            return
+
+        cls.objects.bulk_create(
+            [
+                cls(conversation_id=message.conversation_id, user_id=user_id)
+                for batch in conversations.values()
+                for message in batch[:1]
+                for user_id in {message.sender_id, message.receiver_id}
+            ],
+            ignore_conflicts=True,
+        )
+
+        # one UPDATE per conversation covers both participants
+        for conversation_id, batch in conversations.items():
+            last = max(batch, key=lambda message: message.id)
+            newer = models.Q(last_message_id__isnull=True) | models.Q(last_message_id__lt=last.id)
+
+            received = {}
+            for message in batch:
+                received[message.receiver_id] = received.get(message.receiver_id, 0) + 1
+
+            cls.objects.filter(conversation_id=conversation_id).update(
+                last_message_at=models.Case(
+                    models.When(newer, then=models.Value(last.date)), default=models.F('last_message_at'),
+                ),
+                last_message_id=models.Case(
+                    models.When(newer, then=models.Value(last.id)), default=models.F('last_message_id'),
+                    output_field=models.BigIntegerField(),
+                ),
+                unread_count=models.Case(
+                    *(models.When(user_id=user_id, then=models.F('unread_count') + count)
+                      for user_id, count in received.items()),
+                    default=models.F('unread_count'),
+                    output_field=models.PositiveIntegerField(),
+                ),
+            )
+
+
+    @classmethod
+    def mark_read(cls, user_id, conversation_id, up_to=None, up_to_uid=None):
+        """
+        Marks every message the user received in the conversation up to
+        message id ``up_to``, or up to the message with uid ``up_to_uid``
+        (what socket clients get), as read; all stored messages if neither
+        is given. One UPDATE on messages and one on the summary. Returns
+        how many messages changed.
+        """
+        messages = Message.objects.filter(conversation_id=conversation_id, receiver_id=user_id, is_read=False)
+        if up_to is not None:
+            messages = messages.filter(id__lte=up_to)
+        elif up_to_uid is not None:
+            # a uid that is not stored matches nothing
+            messages = messages.filter(id__lte=models.Subquery(
+                Message.objects.filter(conversation_id=conversation_id, uid=up_to_uid).values('id')[:1]
+            ))
+
+        with transaction.atomic():
+            count = messages.update(is_read=True, updated_at=timezone.now())
+            if count:
+                cls.objects.filter(conversation_id=conversation_id, user_id=user_id).update(
+                    unread_count=Greatest(models.F('unread_count') - count, 0)
+                )
+        return count
@@ -1,18 +1,215 @@
+import time
+
 import redis
 from django.conf import settings
 
-redis_client = redis.StrictRedis(host="127.0.0.1", port=6379, db=0)
+from api.cache import invalidate_profiles
+from api.models import Message, Profile
+
+redis_client = redis.StrictRedis.from_url(settings.PRESENCE_REDIS_URL)
+
+# zset of user ids scored by the expiry of their freshest connection
+ONLINE_USERS_KEY = "presence:online"
+# zset of channel names per user, scored by the connection expiry
+CONNECTIONS_KEY = "presence:connections:"
+# set of user ids whose online state changed since the last profile sync
+DIRTY_USERS_KEY = "presence:dirty"
+# per-group counter stamped on every presence delta so clients can detect gaps
+SEQUENCE_KEY = "presence:seq:"
+# set of user ids a user has conversations with, i.e. whose presence they see
+CONTACTS_KEY = "presence:contacts:"
+# stored in every contacts set so users without conversations are cached too
+NO_CONTACT = 0
+
+
+# Registers (or refreshes) one connection and reports whether the user
+# went from offline to online.
+_add_connection = redis_client.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local was_online = redis.call('ZCARD', KEYS[1]) > 0
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+if was_online then
+    return 0
+end
+redis.call('SADD', KEYS[3], ARGV[4])
+return 1
+""")
+
+# Drops one connection and reports whether it was the user's last one.
+_remove_connection = redis_client.register_script("""
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) > 0 then
+    return 0
+end
+if redis.call('ZREM', KEYS[2], ARGV[3]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[3], ARGV[3])
+return 1
+""")
+
+# Removes users whose connections all stopped sending heartbeats,
+# e.g. because the worker holding them crashed.
+_expire_stale = redis_client.register_script("""
+local gone = {}
+for _, uid in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])) do
+    local conns = ARGV[2] .. uid
+    redis.call('ZREMRANGEBYSCORE', conns, '-inf', ARGV[1])
+    local freshest = redis.call('ZRANGE', conns, -1, -1, 'WITHSCORES')
+    if #freshest == 0 then
+        redis.call('ZREM', KEYS[1], uid)
+        redis.call('SADD', KEYS[2], uid)
+        table.insert(gone, uid)
+    else
+        redis.call('ZADD', KEYS[1], freshest[2], uid)
+    end
+end
+return gone
+""")
+
+# Adds the pair to each other's cached contacts, leaving uncached users alone.
+_add_contact = redis_client.register_script("""
+for i = 1, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('SADD', KEYS[i], ARGV[i])
+    end
+end
+""")
 
-ONLINE_USERS_KEY = "online_users"
 
+def add_connection(user_id, channel_name):
+    """
+    Registers a connection for the user or refreshes its heartbeat.
 
-def add_user_online(user_id):
-    redis_client.sadd(ONLINE_USERS_KEY, user_id)
+    Returns True when this is the user's first live connection.
+    """
+    now = time.time()
+    return bool(_add_connection(
+        keys=[CONNECTIONS_KEY + str(user_id), ONLINE_USERS_KEY, DIRTY_USERS_KEY],
+        args=[channel_name, now, now + settings.PRESENCE_TTL, user_id, settings.PRESENCE_TTL],
+    ))
 
 
-def remove_user_online(user_id):
-    redis_client.srem(ONLINE_USERS_KEY, user_id)
+def remove_connection(user_id, channel_name):
+    """
+    Unregisters a connection.
+
+    Returns True when the user has no live connections left.
+    """
+    return bool(_remove_connection(
+        keys=[CONNECTIONS_KEY + str(user_id), ONLINE_USERS_KEY, DIRTY_USERS_KEY],
+        args=[channel_name, time.time(), user_id],
+    ))
+
+
+def expire_stale_connections():
+    return [int(uid) for uid in _expire_stale(
+        keys=[ONLINE_USERS_KEY, DIRTY_USERS_KEY],
+        args=[time.time(), CONNECTIONS_KEY],
+    )]
 
 
 def get_online_users():
-    return [int(uid) for uid in redis_client.smembers(ONLINE_USERS_KEY)]
+    return [int(uid) for uid in redis_client.zrangebyscore(ONLINE_USERS_KEY, time.time(), "+inf")]
+
+
+def online_among(user_ids):
+    user_ids = list(user_ids)
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zscore(ONLINE_USERS_KEY, user_id)
+    return [uid for uid, score in zip(user_ids, pipe.execute()) if score is not None and score >= now]
+
+
+def get_contacts(user_id):
+    """
+    Returns the ids of everyone the user has exchanged messages with,
+    cached in Redis for PRESENCE_CONTACTS_TTL seconds.
+    """
+    key = CONTACTS_KEY + str(user_id)
+    members = redis_client.smembers(key)
+    if not members:
+        members = {NO_CONTACT}
+        members.update(
+            Message.objects.filter(sender_id=user_id).order_by().values_list('receiver_id', flat=True)
+            .union(Message.objects.filter(receiver_id=user_id).order_by().values_list('sender_id', flat=True))
+        )
+        pipe = redis_client.pipeline()
+        pipe.sadd(key, *members)
+        pipe.expire(key, settings.PRESENCE_CONTACTS_TTL)
+        pipe.execute()
+    return {int(uid) for uid in members} - {NO_CONTACT, user_id}
+
+
+def add_contact(user_id, other_id):
+    _add_contact(keys=[CONTACTS_KEY + str(user_id), CONTACTS_KEY + str(other_id)], args=[other_id, user_id])
+
+
+def next_sequence(group):
+    return redis_client.incr(SEQUENCE_KEY + group)
+
+
+def current_sequence(group):
+    return int(redis_client.get(SEQUENCE_KEY + group) or 0)
+
+
+def pop_dirty_users():
+    pipe = redis_client.pipeline()
+    pipe.smembers(DIRTY_USERS_KEY)
+    pipe.delete(DIRTY_USERS_KEY)
+    members, _ = pipe.execute()
+    return [int(uid) for uid in members]
+
+
+def sync_profiles():
+    """
+    Writes the online state of every user that changed since the last
+    call back to ``Profile.is_online`` with two batched UPDATEs. Run
+    ``expire_stale_connections`` first (and broadcast who it expired) so
+    crashed connections are included.
+    """
+    user_ids = pop_dirty_users()
+    if not user_ids:
+        return [], []
+
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zscore(ONLINE_USERS_KEY, user_id)
+    scores = pipe.execute()
+
+    online = [uid for uid, score in zip(user_ids, scores) if score is not None and score >= now]
+    offline = [uid for uid, score in zip(user_ids, scores) if score is None or score < now]
+
+    try:
+        Profile.objects.filter(user_id__in=online).update(is_online=True)
+        Profile.objects.filter(user_id__in=offline).update(is_online=False)
+    except Exception:
+        redis_client.sadd(DIRTY_USERS_KEY, *user_ids)
+        raise
+
+    # update() sends no post_save, so cached profiles are invalidated here
+    invalidate_profiles(user_ids)
+    return online, offline
+
+
+def reconcile_profiles():
+    """
+    Makes ``Profile.is_online`` match Redis for every user, clearing
+    flags left behind by a Redis restart or a crashed sync process.
+    Like ``sync_profiles``, it does not expire stale connections itself.
+    """
+    online = get_online_users()
+    went_offline = list(
+        Profile.objects.filter(is_online=True).exclude(user_id__in=online).values_list('user_id', flat=True)
+    )
+    went_online = list(
+        Profile.objects.filter(is_online=False, user_id__in=online).values_list('user_id', flat=True)
+    )
+    Profile.objects.filter(user_id__in=went_offline).update(is_online=False)
+    Profile.objects.filter(user_id__in=went_online).update(is_online=True)
+    invalidate_profiles(went_offline + went_online)
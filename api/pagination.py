@@ -0,0 +1,162 @@
+import base64
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+
+
+def _int_param(request, name, default=None):
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: "Must be an integer."})
+
+
+class StandardLimitOffsetPagination(LimitOffsetPagination):
+    """
+    Project default (REST_FRAMEWORK['DEFAULT_PAGINATION_CLASS']) for lists
+    with a stable order. ``?limit`` is capped so one request can never
+    return a whole table.
+    """
+    default_limit = 20
+    max_limit = 100
+
+
+class TaskCursorPagination(CursorPagination):
+    """
+    Cursor pagination for lists that keep growing, so pages stay
+    consistent while rows are added and deep pages cost no OFFSET scan.
+    """
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination over message ids.
+
+    - no parameters: the newest ``limit`` messages
+    - ``?before=<id>``: the ``limit`` messages older than ``id`` ("load older")
+    - ``?since=<id>``: up to ``limit`` messages newer than ``id``
+
+    Results are always in ascending id order. ``before`` and ``since`` in
+    the response are the ids to pass for the next older / newer page.
+    """
+    default_limit = 50
+    max_limit = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = min(max(_int_param(request, 'limit', self.default_limit), 1), self.max_limit)
+        before = _int_param(request, 'before')
+        since = _int_param(request, 'since')
+
+        if since is not None:
+            page = list(queryset.filter(id__gt=since).order_by('id')[:limit + 1])
+            self.has_more = len(page) > limit
+            page = page[:limit]
+        else:
+            if before is not None:
+                queryset = queryset.filter(id__lt=before)
+            page = list(queryset.order_by('-id')[:limit + 1])
+            self.has_more = len(page) > limit
+            page = page[:limit][::-1]
+
+        self.before = page[0].id if page else before
+        self.since = page[-1].id if page else since
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            "results": data,
+            "has_more": self.has_more,
+            "before": self.before,
+            "since": self.since,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "results": schema,
+                "has_more": {"type": "boolean"},
+                "before": {"type": "integer", "nullable": True},
+                "since": {"type": "integer", "nullable": True},
+            },
+        }
+
+
+class SyncCursorPagination(BasePagination):
+    """
+    Delta sync over ``(updated_at, id)``.
+
+    - no ``?since``: everything, oldest change first (initial sync)
+    - ``?since=<cursor>``: rows changed after the cursor
+
+    ``cursor`` in the response is the value to send as ``since`` next time;
+    when ``has_more`` is true the client should ask again right away.
+    Tombstones are rows like any other, so deletions are synced too.
+
+    ``updated_at`` is taken before the writing transaction commits, so a
+    row can become visible with a timestamp older than rows a client has
+    already synced past. Rows changed in the last ``SYNC_SAFETY_LAG``
+    seconds are therefore left for the next sync; writes that take longer
+    than that to commit can still be missed.
+    """
+    default_limit = 100
+    max_limit = 500
+
+    @staticmethod
+    def encode_cursor(row):
+        value = f"{row.updated_at.isoformat()}|{row.id}"
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            updated_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(updated_at), int(id)
+        except ValueError:
+            raise ValidationError({"since": "Invalid cursor."})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = min(max(_int_param(request, 'limit', self.default_limit), 1), self.max_limit)
+        since = request.query_params.get('since')
+
+        if since:
+            updated_at, id = self.decode_cursor(since)
+            queryset = queryset.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=id))
+        queryset = queryset.filter(
+            updated_at__lte=timezone.now() - timedelta(seconds=settings.SYNC_SAFETY_LAG),
+        )
+
+        page = list(queryset.order_by('updated_at', 'id')[:limit + 1])
+        self.has_more = len(page) > limit
+        page = page[:limit]
+        self.cursor = self.encode_cursor(page[-1]) if page else since
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            "results": data,
+            "has_more": self.has_more,
+            "cursor": self.cursor,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "results": schema,
+                "has_more": {"type": "boolean"},
+                "cursor": {"type": "string", "nullable": True},
+            },
+        }
@@ -0,0 +1,139 @@
+import asyncio
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from api import metrics, online_tracker
+from api.serialization import event_text
+
+
+def presence_group(user_id):
+    """
+    Every user's sockets join their own presence group, which receives
+    the presence of that user's contacts only.
+    """
+    return f"presence_{user_id}"
+
+
+def contact_groups(user_id):
+    """
+    Groups that should hear about the user's presence: those of contacts
+    that are online right now.
+    """
+    contacts = online_tracker.get_contacts(user_id)
+    return [presence_group(contact_id) for contact_id in online_tracker.online_among(contacts)]
+
+
+def send_left(user_ids):
+    """
+    Immediately broadcasts that the users went offline, for callers
+    outside the event loop such as the sync_presence command.
+    """
+    left = {}
+    for user_id in user_ids:
+        for group in contact_groups(user_id):
+            left.setdefault(group, []).append(user_id)
+
+    for group, group_left in left.items():
+        message = {
+            "type": "presence",
+            "seq": online_tracker.next_sequence(group),
+            "joined": [],
+            "left": group_left,
+        }
+        async_to_sync(get_channel_layer().group_send)(
+            group,
+            {
+                "type": "online_users_message",
+                "message": message,
+                "text": event_text(message),
+            }
+        )
+
+
+class PresenceBroadcaster:
+    """
+    Coalesces presence changes per group within PRESENCE_BROADCAST_WINDOW
+    seconds and sends them as a single delta, so a burst of connections
+    costs one group_send per window instead of one per connection.
+
+    Only the latest change per user is kept: a user who joins and leaves
+    within the window is sent as ``left`` once.
+    """
+
+    def __init__(self, window=None):
+        self.window = settings.PRESENCE_BROADCAST_WINDOW if window is None else window
+        self.pending = {}
+        self.received = {}
+        # flush_later tasks still in their window, by group
+        self.tasks = {}
+        # every flush_later task not finished yet, including those sending
+        self.running = set()
+
+    def publish(self, group, joined=(), left=()):
+        changes = self.pending.setdefault(group, {})
+        for user in joined:
+            changes[user["user_id"]] = user
+        for user_id in left:
+            changes[user_id] = None
+        self.received[group] = self.received.get(group, 0) + len(joined) + len(left)
+
+        if group not in self.tasks:
+            task = self.tasks[group] = asyncio.create_task(self.flush_later(group))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def flush_later(self, group):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            del self.tasks[group]
+        await self.flush(group)
+
+    async def drain(self):
+        """
+        Sends every pending delta now and waits for deltas being sent.
+        Called at lifespan shutdown (backend/asgi.py), after the server
+        closed every socket: the loop stops right after, which would cancel
+        the waiting flush tasks and lose the ``left`` of those sockets.
+        """
+        waiting = list(self.tasks.values())
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*(self.flush(group) for group in list(self.pending)))
+        sending = self.running.difference(waiting)
+        if sending:
+            await asyncio.wait(sending)
+
+    async def flush(self, group):
+        changes = self.pending.pop(group, {})
+        received = self.received.pop(group, 0)
+        if not changes:
+            return
+
+        message = {
+            "type": "presence",
+            "seq": await sync_to_async(online_tracker.next_sequence, thread_sensitive=False)(group),
+            "joined": [user for user in changes.values() if user is not None],
+            "left": [user_id for user_id, user in changes.items() if user is None],
+        }
+        await get_channel_layer().group_send(
+            group,
+            {
+                "type": "online_users_message",
+                "message": message,
+                # encoded once here rather than once per receiving socket
+                "text": event_text(message),
+            }
+        )
+        await sync_to_async(metrics.incr, thread_sensitive=False)(
+            "presence",
+            events=received,
+            sent=len(changes),
+            merged=received - len(changes),
+            batches=1,
+        )
+
+
+broadcaster = PresenceBroadcaster()
@@ -0,0 +1,100 @@
+from django.conf import settings
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+
+from api.models import Profile
+
+# FTS5 table kept in sync by triggers on SQLite, see migration 0011
+SQLITE_SEARCH_TABLE = "api_profile_search"
+
+
+def search_profiles(term, limit=None):
+    """
+    Profiles whose username, name or email contain ``term``, best matches
+    first: prefix matches before substring matches, then by similarity.
+    Runs a single indexed query and returns at most ``limit`` profiles.
+    """
+    limit = limit or settings.SEARCH_RESULT_LIMIT
+    if connection.vendor == "postgresql":
+        return _search_postgresql(term, limit)
+    if connection.vendor == "sqlite" and len(term) >= 3:
+        return _search_sqlite(term, limit)
+    return _search_fallback(term, limit)
+
+
+def _matches(term):
+    return (
+        Q(user__username__icontains=term) |
+        Q(name__icontains=term) |
+        Q(user__email__icontains=term)
+    )
+
+
+def _prefix_rank(term):
+    return Case(
+        When(
+            Q(user__username__istartswith=term) | Q(name__istartswith=term) | Q(user__email__istartswith=term),
+            then=Value(1),
+        ),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def _matching_ids(term):
+    # One query per indexed column, combined with UNION: an OR across the
+    # api_user/api_profile join could not use the pg_trgm GIN indexes and
+    # would filter both full tables. Each branch here is a bitmap scan of
+    # its own index (migration 0011) joined on the unique user_id.
+    return (
+        Profile.objects.filter(name__icontains=term).values('id')
+        .union(
+            Profile.objects.filter(user__username__icontains=term).values('id'),
+            Profile.objects.filter(user__email__icontains=term).values('id'),
+        )
+    )
+
+
+def _search_postgresql(term, limit):
+    # ranking only runs on the profiles found through the indexes
+    return list(
+        Profile.objects.filter(id__in=_matching_ids(term))
+        .annotate(
+            prefix=_prefix_rank(term),
+            similarity=Greatest(
+                TrigramSimilarity('user__username', term),
+                TrigramSimilarity('name', term),
+                TrigramSimilarity('user__email', term),
+            ),
+        )
+        .order_by('-prefix', '-similarity', 'id')[:limit]
+    )
+
+
+def _search_sqlite(term, limit):
+    # the trigram tokenizer matches any substring of three or more characters
+    phrase = '"' + term.replace('"', '""') + '"'
+    prefix = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return list(Profile.objects.raw(
+        f"""
+        SELECT profile.* FROM {SQLITE_SEARCH_TABLE} AS search
+        JOIN api_profile AS profile ON profile.id = search.rowid
+        WHERE {SQLITE_SEARCH_TABLE} MATCH %s
+        ORDER BY (search.username LIKE %s ESCAPE '\\'
+                  OR search.name LIKE %s ESCAPE '\\'
+                  OR search.email LIKE %s ESCAPE '\\') DESC,
+                 search.rank, profile.id
+        LIMIT %s
+        """,
+        [phrase, prefix, prefix, prefix, limit],
+    ))
+
+
+def _search_fallback(term, limit):
+    return list(
+        Profile.objects.filter(_matches(term))
+        .annotate(prefix=_prefix_rank(term))
+        .order_by('-prefix', 'id')[:limit]
+    )
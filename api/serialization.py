@@ -0,0 +1,140 @@
+"""
+Wire encodings. JSON for WebSocket frames and DRF responses goes through
+orjson when it is installed and the standard library otherwise; both
+produce compact UTF-8 JSON. Sockets that negotiate it get MessagePack.
+"""
+import json
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# handles what neither encoder does natively (Decimal, lazy strings, ...)
+_default = JSONEncoder().default
+
+
+if orjson is not None:
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z)
+
+    def loads(data):
+        return orjson.loads(data)
+
+    DecodeError = orjson.JSONDecodeError
+else:
+    def dumps_bytes(obj):
+        return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":")).encode()
+
+    def loads(data):
+        return json.loads(data)
+
+    DecodeError = json.JSONDecodeError
+
+
+def dumps(obj):
+    """
+    ``obj`` as a JSON string, for text frames.
+    """
+    return dumps_bytes(obj).decode()
+
+
+def event_text(frame):
+    """
+    Encodes a frame once on the sending side of a group_send. Put the
+    result in the event as ``"text"``; consumers send it as is instead of
+    encoding the same payload for every socket (see ``frame_text``).
+    """
+    return dumps(frame)
+
+
+def frame_text(event, build):
+    """
+    The pre-encoded ``event["text"]`` if the sender added one, otherwise
+    ``build()`` encoded here.
+    """
+    text = event.get("text")
+    return text if text is not None else dumps(build())
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    ``JSONRenderer`` backed by ``dumps_bytes``. Indented output (the
+    browsable API, ``?indent=``) still goes through DRF's own encoder.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps_bytes(data)
+
+
+class FastJSONParser(JSONParser):
+    """
+    ``JSONParser`` backed by ``loads``.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except (DecodeError, UnicodeDecodeError) as exc:
+            raise ParseError(f"JSON parse error - {exc}")
+
+
+# MessagePack frames (opt-in WebSocket subprotocol), see WireFormatMixin in
+# api/consumers.py. Field names are shortened on the way out and restored
+# on the way in; keys not listed are sent as is.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+COMPACT_KEYS = {
+    "type": "t",
+    "message": "m",
+    "uid": "u",
+    "conversation": "c",
+    "sender": "s",
+    "receiver": "r",
+    "date": "d",
+    "client_id": "i",
+    "status": "st",
+    "error": "e",
+    "reader": "rd",
+    "up_to": "ut",
+    "up_to_uid": "uu",
+    "seq": "q",
+    "data": "D",
+    "joined": "j",
+    "left": "l",
+    "user_id": "id",
+    "user__username": "un",
+    "name": "n",
+    "is_online": "o",
+}
+EXPANDED_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+
+
+def _rename(obj, keys):
+    if isinstance(obj, dict):
+        return {keys.get(key, key): _rename(value, keys) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_rename(value, keys) for value in obj]
+    return obj
+
+
+def pack(obj):
+    return msgpack.packb(_rename(obj, COMPACT_KEYS), use_bin_type=True, default=_default)
+
+
+def unpack(data):
+    return _rename(msgpack.unpackb(data, raw=False), EXPANDED_KEYS)
@@ -1,5 +1,7 @@
 from api.models import User, Profile, Task, Message
+from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework import serializers
 
@@ -13,6 +15,13 @@ class ProfileSerializer(serializers.ModelSerializer):
         model = Profile
         fields = ['id', 'user', 'name', 'gender', 'bio', 'date_of_birth', 'is_online', 'photo']
 
+    def update(self, instance, validated_data):
+        # partial updates write only the columns that were sent
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
+
 
 class TokenSerializer(TokenObtainPairSerializer):
     @classmethod
@@ -40,14 +49,17 @@ class RegisterSerializer(serializers.ModelSerializer):
             return attrs
     
     def create(self, validated_data):
-        user = User.objects.create(
+        # one INSERT for the user (password already hashed) and one for
+        # its profile from create_profile, committed together
+        user = User(
             username=validated_data['username'],
             email=validated_data['email'],
             # date_of_birth=validated_data['date_of_birth'],
             # gender=validated_data['gender']
             )
         user.set_password(validated_data['password'])
-        user.save()
+        with transaction.atomic():
+            user.save()
 
         return user
 
@@ -58,6 +70,35 @@ class TaskSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'title', 'completed']
 
 
+class TaskSyncSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Task
+        fields = ['id', 'user', 'title', 'completed', 'updated_at', 'deleted_at']
+
+
+class TaskOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['create', 'update', 'complete', 'delete'])
+    id = serializers.IntegerField(required=False)
+    title = serializers.CharField(max_length=1000, required=False)
+    completed = serializers.BooleanField(required=False)
+
+    def validate(self, attrs):
+        if attrs['op'] == 'create':
+            if 'title' not in attrs:
+                raise serializers.ValidationError({"title": "This field is required."})
+        elif 'id' not in attrs:
+            raise serializers.ValidationError({"id": "This field is required."})
+        return attrs
+
+
+class TaskBatchSerializer(serializers.Serializer):
+    # items are validated one by one (TaskOperationSerializer) so a bad item
+    # is reported in its result instead of rejecting the whole batch
+    operations = serializers.ListField(
+        child=serializers.JSONField(), allow_empty=False, max_length=settings.TASK_BATCH_MAX_OPERATIONS,
+    )
+
+
 class MessageSerializer(serializers.ModelSerializer):
     receiver_profile = ProfileSerializer(read_only=True)
     sender_profile = ProfileSerializer(read_only=True)
@@ -67,5 +108,22 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'sender', 'receiver', 'sender_profile', 'receiver_profile', 'message', 'date', 'is_read']    
 
 
+class MessageSyncSerializer(MessageSerializer):
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['updated_at']
+
+
+class MarkReadSerializer(serializers.Serializer):
+    up_to = serializers.IntegerField(required=False, allow_null=True)
+    up_to_uid = serializers.UUIDField(required=False, allow_null=True)
+
+    def validate(self, attrs):
+        if attrs.get('up_to') is not None and attrs.get('up_to_uid') is not None:
+            raise serializers.ValidationError("Send either up_to or up_to_uid, not both.")
+        return attrs
+
 
-    
\ No newline at end of file
+class UnreadCountSerializer(serializers.Serializer):
+    conversation = serializers.IntegerField()
+    user_id = serializers.IntegerField()
+    unread_count = serializers.IntegerField()
@@ -0,0 +1,32 @@
+from django.db import transaction
+
+from api.broadcast import group_send
+from api.serialization import event_text
+from api.serializer import TaskSyncSerializer
+
+
+def task_group(user_id):
+    """
+    Every socket of a user joins their task group (api.consumers.TaskConsumer).
+    """
+    return f"tasks_{user_id}"
+
+
+def publish(user_id, changes):
+    """
+    Pushes ``(event, task)`` pairs (``created``, ``updated`` or ``deleted``)
+    to the user's devices once the current transaction commits, so a
+    rolled back change is never announced. Tasks are serialized like the
+    delta sync, tombstones included. Delivery is best effort (see
+    ``api.broadcast.group_send``); devices catch up with a delta sync.
+    """
+    if not changes:
+        return
+
+    events = [{"event": event, "task": TaskSyncSerializer(task).data} for event, task in changes]
+    message = {
+        "type": "task_events",
+        "events": events,
+        "text": event_text({"type": "tasks", "events": events}),
+    }
+    transaction.on_commit(lambda: group_send(task_group(user_id), message))
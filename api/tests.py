@@ -1,3 +1,390 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from channels.testing import WebsocketCommunicator
+from django.db import IntegrityError, OperationalError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api import message_queue
+from api.consumers import ChatConsumer
+from api.models import User, Message, Task
+from api.serialization import MSGPACK_SUBPROTOCOL, dumps, loads, msgpack, pack, unpack
+
+
+class MessageQueryCountTest(TestCase):
+    """
+    Serializing messages must not run a profile query per row.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@example.com")
+        self.bob = User.objects.create(username="bob", email="bob@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, count):
+        for i in range(count):
+            sender, receiver = (self.alice, self.bob) if i % 2 else (self.bob, self.alice)
+            Message.objects.create(user=sender, sender=sender, receiver=receiver, message=f"message {i}")
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_get_messages_queries_do_not_grow_with_messages(self):
+        url = f"/api/get-messages/{self.alice.id}/{self.bob.id}/"
+        self.send(2)
+        few = self.count_queries(url)
+        self.send(20)
+        self.assertEqual(self.count_queries(url), few)
+
+    def test_inbox_queries_do_not_grow_with_conversations(self):
+        url = f"/api/my-messages/{self.alice.id}/"
+        self.send(1)
+        few = self.count_queries(url)
+        for i in range(10):
+            other = User.objects.create(username=f"user{i}", email=f"user{i}@example.com")
+            Message.objects.create(user=other, sender=other, receiver=self.alice, message="hi")
+        self.assertEqual(self.count_queries(url), few)
+
+
+class ChatWriterTest(TestCase):
+    """
+    A batch that fails because the database is unreachable must stay in
+    the processing list so the writer retries it.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@example.com")
+        self.bob = User.objects.create(username="bob", email="bob@example.com")
+        conversation = Message.objects.create(
+            user=self.alice, sender=self.alice, receiver=self.bob, message="hi",
+        ).conversation_id
+        self.entry = message_queue.new_entry(conversation, self.alice.id, self.bob.id, "queued")
+
+    def test_unreachable_database_keeps_batch_for_retry(self):
+        with mock.patch.object(message_queue, "redis_client") as redis_client, \
+                mock.patch.object(message_queue, "_take_batch", return_value=[dumps(self.entry)]), \
+                mock.patch.object(Message.objects, "bulk_create", side_effect=OperationalError("server closed")):
+            with self.assertRaises(OperationalError):
+                message_queue.flush(10, "writer")
+        redis_client.delete.assert_not_called()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_WRITE_BEHIND=False,
+    CHAT_FLUSH_WINDOW=0,
+)
+class ChatProtocol2Test(TestCase):
+    """
+    Chat protocol 2 with messages written directly, so retries are
+    dropped by the unique message uid.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@example.com")
+        self.bob = User.objects.create(username="bob", email="bob@example.com")
+
+    async def connect(self, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f"/ws/chat/{self.alice.id}/{self.bob.id}/?protocol=2",
+            subprotocols=subprotocols,
+        )
+        communicator.scope["user"] = self.alice
+        communicator.scope["url_route"] = {"kwargs": {"sender_id": self.alice.id, "receiver_id": self.bob.id}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def events(self, communicator):
+        """
+        Every event sent to the socket so far, batches flattened.
+        """
+        events = []
+        while not await communicator.receive_nothing(timeout=0.05):
+            frame = await communicator.receive_output()
+            if frame.get("bytes") is not None:
+                events.extend(unpack(frame["bytes"]))
+            else:
+                events.extend(loads(frame["text"]))
+        return events
+
+    def acks(self, events):
+        return [(event["client_id"], event["status"]) for event in events if event["type"] == "ack"]
+
+    def message(self, client_id, text="hi"):
+        return {"type": "message", "client_id": client_id, "message": text}
+
+    async def test_retries_are_acked_as_duplicates_and_stored_once(self):
+        communicator = await self.connect()
+        await communicator.send_to(text_data=dumps([self.message("a"), self.message("a"), self.message("b")]))
+        events = await self.events(communicator)
+        self.assertEqual(self.acks(events), [("a", "accepted"), ("a", "duplicate"), ("b", "accepted")])
+        self.assertEqual(len([event for event in events if event["type"] == "chat_message"]), 2)
+
+        # the client did not get the ack and sends the message again
+        await communicator.send_to(text_data=dumps(self.message("a")))
+        events = await self.events(communicator)
+        self.assertEqual(self.acks(events), [("a", "duplicate")])
+        self.assertFalse([event for event in events if event["type"] == "chat_message"])
+        await communicator.disconnect()
+
+        self.assertEqual(await Message.objects.acount(), 2)
+
+    async def test_invalid_messages_are_rejected(self):
+        communicator = await self.connect()
+        await communicator.send_to(text_data=dumps([self.message("a", ""), {"type": "message", "message": "hi"}]))
+        self.assertEqual(self.acks(await self.events(communicator)), [("a", "rejected"), (None, "rejected")])
+        await communicator.disconnect()
+
+        self.assertEqual(await Message.objects.acount(), 0)
+
+    async def test_messages_the_database_refuses_are_rejected(self):
+        communicator = await self.connect()
+        with mock.patch.object(Message.objects, "bulk_create", side_effect=IntegrityError("violates constraint")), \
+                self.assertLogs("api.message_queue", "ERROR"):
+            await communicator.send_to(text_data=dumps(self.message("a")))
+            events = await self.events(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual(self.acks(events), [("a", "rejected")])
+        self.assertFalse([event for event in events if event["type"] == "chat_message"])
+
+    @override_settings(CHAT_MAX_FRAME_ITEMS=2)
+    async def test_frame_over_the_limit_is_rejected_whole(self):
+        communicator = await self.connect()
+        await communicator.send_to(text_data=dumps([self.message("a"), self.message("b"), self.message("c")]))
+        events = await self.events(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual([event["type"] for event in events], ["error"])
+        self.assertEqual(await Message.objects.acount(), 0)
+
+    async def test_undecodable_frame_gets_an_error(self):
+        communicator = await self.connect()
+        await communicator.send_to(text_data="{not json")
+        await communicator.send_to(text_data=dumps(["not an object"]))
+        events = await self.events(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual([event["type"] for event in events], ["error", "error"])
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    async def test_msgpack_frames(self):
+        communicator = await self.connect(subprotocols=[MSGPACK_SUBPROTOCOL])
+        await communicator.send_to(bytes_data=pack([self.message("a", "packed")]))
+        events = await self.events(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual(self.acks(events), [("a", "accepted")])
+        [delivered] = [event["message"] for event in events if event["type"] == "chat_message"]
+        self.assertEqual(delivered["message"], "packed")
+
+
+class TaskBatchTest(TestCase):
+    """
+    /todo-batch/: operations apply in order and every one gets a result.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@example.com")
+        self.bob = User.objects.create(username="bob", email="bob@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def batch(self, operations, user=None):
+        return self.client.post(
+            f"/api/todo-batch/{(user or self.alice).id}/", {"operations": operations}, format="json",
+        )
+
+    def test_mixed_operations(self):
+        renamed = Task.objects.create(user=self.alice, title="old")
+        done = Task.objects.create(user=self.alice, title="done")
+        removed = Task.objects.create(user=self.alice, title="removed")
+
+        response = self.batch([
+            {"op": "create", "title": "new"},
+            {"op": "update", "id": renamed.id, "title": "renamed"},
+            {"op": "complete", "id": done.id},
+            {"op": "delete", "id": removed.id},
+            {"op": "complete", "id": removed.id},
+            {"op": "delete", "id": 999999},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result["status"] for result in response.json()["results"]],
+            ["created", "updated", "updated", "deleted", "not_found", "not_found"],
+        )
+
+        self.assertEqual(
+            sorted(Task.objects.filter(user=self.alice).values_list("title", "completed")),
+            [("done", True), ("new", False), ("renamed", False)],
+        )
+        self.assertIsNotNone(Task.all_objects.get(id=removed.id).deleted_at)
+
+    def test_invalid_operations_are_reported_per_item(self):
+        response = self.batch([
+            {"op": "update", "title": "no id"},
+            "not an object",
+            {"op": "create", "title": "kept"},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([result["status"] for result in results], ["invalid", "invalid", "created"])
+        self.assertIn("id", results[0]["errors"])
+        self.assertEqual(list(Task.objects.values_list("title", flat=True)), ["kept"])
+
+    def test_changes_before_a_delete_are_kept_in_the_tombstone(self):
+        task = Task.objects.create(user=self.alice, title="task")
+        response = self.batch([{"op": "complete", "id": task.id}, {"op": "delete", "id": task.id}])
+        self.assertEqual([result["status"] for result in response.json()["results"]], ["updated", "deleted"])
+
+        task = Task.all_objects.get(id=task.id)
+        self.assertTrue(task.completed)
+        self.assertIsNotNone(task.deleted_at)
+
+    def test_unknown_user(self):
+        self.assertEqual(self.batch([{"op": "create", "title": "task"}], user=User(id=999999)).status_code, 404)
+
+    def test_other_users_tasks_are_forbidden(self):
+        task = Task.objects.create(user=self.bob, title="bob's")
+        response = self.batch([{"op": "delete", "id": task.id}, {"op": "create", "title": "x"}], user=self.bob)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(list(Task.objects.values_list("title", flat=True)), ["bob's"])
+
+
+@override_settings(SYNC_SAFETY_LAG=0)
+class TaskSyncTest(TestCase):
+    """
+    /todo-sync/ (SyncCursorPagination): every change is returned once,
+    oldest first, deletions included.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def sync(self, since=None, **params):
+        if since is not None:
+            params["since"] = since
+        return self.client.get(f"/api/todo-sync/{self.alice.id}/", params)
+
+    def age(self, task, seconds):
+        Task.all_objects.filter(id=task.id).update(updated_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_cursor_round_trip(self):
+        tasks = [Task.objects.create(user=self.alice, title=f"task {i}") for i in range(3)]
+        for i, task in enumerate(tasks):
+            self.age(task, 60 - i)
+
+        first = self.sync(limit=2).json()
+        self.assertEqual([task["title"] for task in first["results"]], ["task 0", "task 1"])
+        self.assertTrue(first["has_more"])
+
+        second = self.sync(first["cursor"], limit=2).json()
+        self.assertEqual([task["title"] for task in second["results"]], ["task 2"])
+        self.assertFalse(second["has_more"])
+
+        nothing = self.sync(second["cursor"]).json()
+        self.assertEqual(nothing["results"], [])
+        self.assertEqual(nothing["cursor"], second["cursor"])
+
+        Task.objects.filter(id=tasks[0].id).update(title="renamed", updated_at=timezone.now())
+        changed = self.sync(second["cursor"]).json()
+        self.assertEqual([task["title"] for task in changed["results"]], ["renamed"])
+
+    def test_deletions_are_synced_as_tombstones(self):
+        task = Task.objects.create(user=self.alice, title="task")
+        self.age(task, 60)
+        cursor = self.sync().json()["cursor"]
+
+        task.delete()
+        [tombstone] = self.sync(cursor).json()["results"]
+        self.assertEqual(tombstone["id"], task.id)
+        self.assertIsNotNone(tombstone["deleted_at"])
+
+    @override_settings(SYNC_SAFETY_LAG=2)
+    def test_recent_changes_wait_for_the_safety_lag(self):
+        task = Task.objects.create(user=self.alice, title="task")
+        response = self.sync().json()
+        self.assertEqual(response["results"], [])
+        self.assertIsNone(response["cursor"])
+
+        self.age(task, 5)
+        self.assertEqual([task["title"] for task in self.sync().json()["results"]], ["task"])
+
+    def test_invalid_cursor(self):
+        for cursor in ("not a cursor", "bm90fGEgY3Vyc29y"):
+            self.assertEqual(self.sync(cursor).status_code, 400)
+
+    def test_other_users_tasks_are_forbidden(self):
+        bob = User.objects.create(username="bob", email="bob@example.com")
+        self.assertEqual(self.client.get(f"/api/todo-sync/{bob.id}/").status_code, 403)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class UnreadCountTest(TestCase):
+    """
+    Unread counters kept in ConversationSummary as messages are sent and read.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@example.com")
+        self.bob = User.objects.create(username="bob", email="bob@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def receive(self, count):
+        return [
+            Message.objects.create(user=self.bob, sender=self.bob, receiver=self.alice, message=f"message {i}")
+            for i in range(count)
+        ]
+
+    def unread_counts(self):
+        response = self.client.get("/api/unread-counts/")
+        self.assertEqual(response.status_code, 200)
+        return [(count["user_id"], count["unread_count"]) for count in response.json()]
+
+    def mark_read(self, **data):
+        return self.client.post(f"/api/mark-read/{self.bob.id}/", data, format="json")
+
+    def test_counts_after_send(self):
+        self.receive(3)
+        Message.objects.create(user=self.alice, sender=self.alice, receiver=self.bob, message="reply")
+        self.assertEqual(self.unread_counts(), [(self.bob.id, 3)])
+
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.unread_counts(), [(self.alice.id, 1)])
+
+    def test_mark_read_up_to_id(self):
+        messages = self.receive(3)
+        response = self.mark_read(up_to=messages[1].id)
+        self.assertEqual(response.json(), {"marked": 2})
+        self.assertEqual(self.unread_counts(), [(self.bob.id, 1)])
+
+        self.assertEqual(self.mark_read().json(), {"marked": 1})
+        self.assertEqual(self.mark_read().json(), {"marked": 0})
+        self.assertEqual(self.unread_counts(), [])
+
+    def test_mark_read_by_uid(self):
+        messages = self.receive(3)
+        self.assertEqual(self.mark_read(up_to_uid=str(messages[0].uid)).json(), {"marked": 1})
+        self.assertEqual(self.unread_counts(), [(self.bob.id, 2)])
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("is_read", flat=True)), [True, False, False],
+        )
+
+        # a uid that is not stored marks nothing
+        self.assertEqual(self.mark_read(up_to_uid="00000000-0000-0000-0000-000000000000").json(), {"marked": 0})
+
+    def test_mark_read_takes_one_bound(self):
+        message = self.receive(1)[0]
+        self.assertEqual(self.mark_read(up_to=message.id, up_to_uid=str(message.uid)).status_code, 400)
+        self.assertEqual(self.unread_counts(), [(self.bob.id, 1)])
@@ -20,10 +20,15 @@ urlpatterns = [
     path("todo/<user_id>/", views.TodoListView.as_view(), name="todo"),
     path("todo-detail/<user_id>/<task_id>/", views.TodoDetailView.as_view(), name="todo-detail"),
     path("todo-completed/<user_id>/<task_id>/", views.TodoCompletedView.as_view(), name="todo-completed"),
+    path("todo-batch/<int:user_id>/", views.TodoBatchView.as_view(), name="todo-batch"),
+    path("todo-sync/<int:user_id>/", views.TodoSyncView.as_view(), name="todo-sync"),
 
     path("my-messages/<user_id>/", views.Inbox.as_view(), name="inbox"),
     path("get-messages/<sender_id>/<receiver_id>/", views.GetMessagesView.as_view(), name="messages"),
+    path("sync-messages/<int:user_id>/", views.MessageSyncView.as_view(), name="sync-messages"),
     path("send-message/", views.SendMessage.as_view(), name="send"),
+    path("mark-read/<int:user_id>/", views.MarkReadView.as_view(), name="mark-read"),
+    path("unread-counts/", views.UnreadCountsView.as_view(), name="unread-counts"),
     path("profile/<int:pk>/", views.ProfileDetailView.as_view(), name="profile"),
     path('profile/<int:user_id>/', views.ProfileView.as_view(), name='profile-detail'),
     path("search/<username>/", views.UserSearch.as_view(), name="search"),
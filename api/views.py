@@ -1,16 +1,23 @@
-from django.db.models import Subquery, OuterRef, Q
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework import generics, status
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.shortcuts import get_object_or_404
+from redis import RedisError
 
-from drf_spectacular.utils import extend_schema, OpenApiResponse
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 
-from api.models import User, Profile, Task, Message
-from api.serializer import UserSerializer, TokenSerializer, RegisterSerializer, TaskSerializer, ProfileSerializer, MessageSerializer
+from api import online_tracker, task_events
+from api.broadcast import group_send
+from api.cache import cached_profile_response, profile_owner
+from api.models import User, Profile, Task, Message, Conversation, ConversationSummary
+from api.pagination import MessageKeysetPagination, SyncCursorPagination, TaskCursorPagination
+from api.search import search_profiles
+from api.serialization import event_text
+from api.serializer import UserSerializer, TokenSerializer, RegisterSerializer, TaskSerializer, TaskSyncSerializer, TaskOperationSerializer, TaskBatchSerializer, ProfileSerializer, MessageSerializer, MessageSyncSerializer, MarkReadSerializer, UnreadCountSerializer
 
 
 @extend_schema(
@@ -51,7 +58,7 @@ class RegisterView(generics.CreateAPIView):
 def set_online(request):
     profile = Profile.objects.get(user=request.user)
     profile.is_online = True
-    profile.save()
+    profile.save(update_fields=['is_online'])
     return Response({"message": "User is now online"}, status=200)
 
 @api_view(['POST'])
@@ -59,7 +66,7 @@ def set_online(request):
 def set_offline(request):
     profile = Profile.objects.get(user=request.user)
     profile.is_online = False
-    profile.save()
+    profile.save(update_fields=['is_online'])
     return Response({"message": "User is now offline"}, status=200)
     
 
@@ -104,6 +111,34 @@ def getRoutes(request):
     return Response(routes)
 
 
+def check_task_owner(request, user_id):
+    """
+    The task endpoints below take the owner from the URL; only the owner
+    may use them.
+    """
+    if user_id != request.user.id:
+        raise PermissionDenied("You can only access your own tasks.")
+
+
+class TaskEventsMixin:
+    """
+    Pushes every task change made through the view to the owner's sockets
+    (api.consumers.TaskConsumer).
+    """
+
+    def perform_create(self, serializer):
+        task = serializer.save()
+        task_events.publish(task.user_id, [("created", task)])
+
+    def perform_update(self, serializer):
+        task = serializer.save()
+        task_events.publish(task.user_id, [("updated", task)])
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        task_events.publish(instance.user_id, [("deleted", instance)])
+
+
 @extend_schema(
     summary="Retrieve or Create Tasks",
     description=(
@@ -119,7 +154,7 @@ def getRoutes(request):
         404: "User not found"
     }
 )
-class TodoListView(generics.ListCreateAPIView):
+class TodoListView(TaskEventsMixin, generics.ListCreateAPIView):
     """
         Endpoint to retrieve a list of tasks for a specific user or create a new task.
 
@@ -128,13 +163,13 @@ class TodoListView(generics.ListCreateAPIView):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = TaskCursorPagination
 
 
     def get_queryset(self):
         user_id = self.kwargs['user_id']
-        user = User.objects.get(id=user_id)
 
-        todo = Task.objects.filter(user=user)
+        todo = Task.objects.filter(user_id=user_id)
         return todo
 
 
@@ -154,7 +189,7 @@ class TodoListView(generics.ListCreateAPIView):
         401: "Unauthorized",
     }
 )
-class TodoDetailView(generics.RetrieveUpdateDestroyAPIView):
+class TodoDetailView(TaskEventsMixin, generics.RetrieveUpdateDestroyAPIView):
    
     serializer_class = TaskSerializer
     permission_classes = [IsAuthenticated]
@@ -163,8 +198,7 @@ class TodoDetailView(generics.RetrieveUpdateDestroyAPIView):
         user_id = self.kwargs['user_id']
         task_id = self.kwargs['task_id']
 
-        user = User.objects.get(id=user_id)
-        task = Task.objects.get(id=task_id, user=user)
+        task = get_object_or_404(Task, id=task_id, user_id=user_id)
 
         return task
 
@@ -181,7 +215,7 @@ class TodoDetailView(generics.RetrieveUpdateDestroyAPIView):
         404: "Task or user not found", 
         401: "Unauthorized"}
 )
-class TodoCompletedView(generics.RetrieveUpdateDestroyAPIView):
+class TodoCompletedView(TaskEventsMixin, generics.RetrieveUpdateDestroyAPIView):
     """
         Endpoint to mark a task as completed.
 
@@ -196,12 +230,107 @@ class TodoCompletedView(generics.RetrieveUpdateDestroyAPIView):
         user_id = self.kwargs['user_id']
         task_id = self.kwargs['task_id']
 
-        user = User.objects.get(id=user_id)
-        task = Task.objects.get(id=task_id, user=user)
+        task = get_object_or_404(Task, id=task_id, user_id=user_id)
 
         task.completed = True
         return task
-    
+
+
+@extend_schema(
+    summary="Create, Update, Complete or Delete Tasks in Bulk",
+    description=(
+        "Applies a list of task operations for a specific user in one transaction. Each operation is an object "
+        "with `op` (`create`, `update`, `complete` or `delete`), the task `id` (all but `create`) and the fields "
+        "`title` / `completed`. The response has one result per operation, in request order, with its `status` "
+        "(`created`, `updated`, `deleted`, `not_found` or `invalid`). `user_id` must be the current user."
+        "\nRoute: `/todo-batch/{user_id}/` \n\n"
+    ),
+    request=TaskBatchSerializer,
+    responses={
+        200: OpenApiResponse(description="Per-operation results"),
+        400: "Bad Request",
+        401: "Unauthorized",
+        403: "Not the current user",
+        404: "User not found"
+    }
+)
+class TodoBatchView(APIView):
+    """
+        Endpoint to sync many tasks in one request.
+
+        Whatever the number of operations, the tasks are written with one bulk INSERT and two UPDATEs (changes and deletions).
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, user_id):
+        batch = TaskBatchSerializer(data=request.data)
+        batch.is_valid(raise_exception=True)
+        get_object_or_404(User.objects.values_list('id', flat=True), id=user_id)
+        check_task_owner(request, user_id)
+
+        results = {}
+        operations = []
+        for index, data in enumerate(batch.validated_data['operations']):
+            # items that are not objects fail here too, with a per-item error
+            operation = TaskOperationSerializer(data=data)
+            if operation.is_valid():
+                operations.append((index, operation.validated_data))
+            else:
+                op = data.get('op') if isinstance(data, dict) else None
+                results[index] = {"index": index, "op": op, "status": "invalid", "errors": operation.errors}
+
+        changes = []
+        for index, op, result, task in Task.apply_batch(user_id, operations):
+            results[index] = {"index": index, "op": op, "status": result}
+            if result in ('created', 'updated'):
+                results[index]["task"] = TaskSerializer(task).data
+                changes.append((result, task))
+            elif result == 'deleted':
+                results[index]["id"] = task.id
+                changes.append((result, task))
+            else:
+                results[index]["id"] = task
+        task_events.publish(user_id, changes)
+
+        return Response({"results": [results[index] for index in sorted(results)]}, status=status.HTTP_200_OK)
+
+
+
+@extend_schema(
+    summary="Sync Tasks",
+    description=(
+        "Returns the tasks of a specific user that changed since `since`, oldest change first, including "
+        "tombstones of deleted tasks (`deleted_at` set). Without `since` every task is returned. Pass the "
+        "returned `cursor` as `since` on the next sync; if `has_more` is true, sync again right away. Changes "
+        "from the last `SYNC_SAFETY_LAG` seconds are returned by the next sync. `user_id` must be the current user."
+        "\nRoute: `/todo-sync/{user_id}/` \n\n"
+    ),
+    parameters=[
+        OpenApiParameter("since", str, description="Cursor returned by the previous sync"),
+        OpenApiParameter("limit", int, description="Page size"),
+    ],
+    request=None,
+    responses={
+        200: TaskSyncSerializer(many=True),
+        400: "Invalid cursor",
+        401: "Unauthorized",
+        403: "Not the current user"
+    }
+)
+class TodoSyncView(generics.ListAPIView):
+    """
+        Endpoint for incremental task sync.
+
+        Reads the `task_sync_idx` index from the cursor on, so the cost depends on the number of changes, not on the size of the list.
+    """
+    serializer_class = TaskSyncSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = SyncCursorPagination
+
+    def get_queryset(self):
+        check_task_owner(self.request, self.kwargs['user_id'])
+        return Task.all_objects.filter(user_id=self.request.user.id)
+
 
 @extend_schema(
     summary="Retrieve Inbox Messages",
@@ -220,36 +349,41 @@ class Inbox(generics.ListAPIView):
     """
         Endpoint to retrieve the inbox messages of a user.
 
-        This endpoint filters messages based on the user's `user_id` and returns them ordered by the most recent.
+        This endpoint returns the last message of every conversation of the user `user_id`, ordered by the most recent.
+        It reads the precomputed `ConversationSummary` rows instead of scanning messages.
     """
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         user_id = self.kwargs['user_id']
-        messages = Message.objects.filter(
-            id__in=Subquery(
-                User.objects.filter(
-                    Q(sender__receiver=user_id) | Q(receiver__sender=user_id)
-                ).distinct().annotate(
-                    last_message = Subquery(
-                        Message.objects.filter(
-                            Q(sender=OuterRef('id'), receiver=user_id) | Q(receiver=OuterRef('id'), sender=user_id)
-                        ).order_by('-id')[:1].values_list('id', flat=True)
-                    )
-                ).values_list('last_message', flat=True).order_by('-id')
-            )
-        ).order_by('-id')
-
-        return messages
+        summaries = ConversationSummary.objects.filter(
+            user_id=user_id, last_message__isnull=False,
+        ).select_related(
+            'last_message__sender__profile', 'last_message__receiver__profile',
+        ).order_by('-last_message_at', '-id')
+
+        return summaries
+
+    def list(self, request, *args, **kwargs):
+        summaries = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer([summary.last_message for summary in summaries], many=True)
+        return self.get_paginated_response(serializer.data)
     
 
 @extend_schema(
     summary="Retrieve Messages Between Two Users",
     description=(
-        "Retrieves all messages exchanged between two specific users."
+        "Retrieves messages exchanged between two specific users, newest page first. "
+        "Pass `before=<id>` to load older messages or `since=<id>` to fetch only newer ones; "
+        "`limit` sets the page size (default 50, max 200)."
         "\nRoute: `/get-messages/{sender_id}/{receiver_id}/` \n\n"
     ),
+    parameters=[
+        OpenApiParameter("before", int, description="Return messages older than this id"),
+        OpenApiParameter("since", int, description="Return messages newer than this id"),
+        OpenApiParameter("limit", int, description="Page size"),
+    ],
     request=None,
     responses={
         200: MessageSerializer, 
@@ -262,20 +396,60 @@ class GetMessagesView(generics.ListAPIView):
         Endpoint to retrieve messages exchanged between two specific users.
 
         This endpoint requires `sender_id` and `receiver_id` as URL parameters.
+        Results are paginated by message id, see `MessageKeysetPagination`.
     """
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageKeysetPagination
+
     def get_queryset(self):
-        sender_id = self.kwargs['sender_id']
-        receiver_id = self.kwargs['receiver_id']
-        
+        user_low_id, user_high_id = sorted((int(self.kwargs['sender_id']), int(self.kwargs['receiver_id'])))
+
         messages = Message.objects.filter(
-            sender__in=[sender_id, receiver_id],
-            receiver__in=[sender_id, receiver_id],
-        )
+            conversation__user_low_id=user_low_id,
+            conversation__user_high_id=user_high_id,
+        ).select_related('sender__profile', 'receiver__profile')
         return messages
     
 
+@extend_schema(
+    summary="Sync Messages",
+    description=(
+        "Returns the messages of the conversation between the current user and `user_id` that were sent or "
+        "changed (e.g. marked as read) since `since`, oldest change first. Without `since` every message is "
+        "returned. Pass the returned `cursor` as `since` on the next sync; if `has_more` is true, sync again right away. "
+        "Changes from the last `SYNC_SAFETY_LAG` seconds are returned by the next sync."
+        "\nRoute: `/sync-messages/{user_id}/` \n\n"
+    ),
+    parameters=[
+        OpenApiParameter("since", str, description="Cursor returned by the previous sync"),
+        OpenApiParameter("limit", int, description="Page size"),
+    ],
+    request=None,
+    responses={
+        200: MessageSyncSerializer(many=True),
+        400: "Invalid cursor",
+        401: "Unauthorized"
+    }
+)
+class MessageSyncView(generics.ListAPIView):
+    """
+        Endpoint for incremental message sync.
+
+        Reads the `message_sync_idx` index from the cursor on, see `SyncCursorPagination`.
+    """
+    serializer_class = MessageSyncSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = SyncCursorPagination
+
+    def get_queryset(self):
+        user_low_id, user_high_id = sorted((self.request.user.id, self.kwargs['user_id']))
+
+        return Message.objects.filter(
+            conversation__user_low_id=user_low_id, conversation__user_high_id=user_high_id,
+        ).select_related('sender__profile', 'receiver__profile')
+
+
 @extend_schema(
     summary="Send a Message",
     description=(
@@ -297,6 +471,112 @@ class SendMessage(generics.CreateAPIView):
     """
     serializer_class = MessageSerializer
 
+    def perform_create(self, serializer):
+        message = serializer.save()
+        try:
+            online_tracker.add_contact(message.sender_id, message.receiver_id)
+        except RedisError:
+            # the message is committed; the cached contact list expires on its own
+            pass
+        data = {
+            "uid": str(message.uid),
+            "sender": message.sender_id,
+            "receiver": message.receiver_id,
+            "message": message.message,
+            "date": message.date.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        # the message is committed either way; the receiver also gets it on sync
+        group_send(
+            message.conversation.group_name,
+            {
+                "type": "chat_message",
+                "message": data,
+                "text": event_text({"type": "chat_message", "message": data}),
+            }
+        )
+
+
+@extend_schema(
+    summary="Mark Messages as Read",
+    description=(
+        "Marks every message the current user received from `user_id` up to the message id `up_to` "
+        "(or the message uid `up_to_uid`) as read. Without either all stored messages of the "
+        "conversation are marked."
+        "\nRoute: `/mark-read/{user_id}/` \n\n"
+    ),
+    request=MarkReadSerializer,
+    responses={
+        200: OpenApiResponse(description="Number of messages marked as read"),
+        400: "Bad Request",
+        401: "Unauthorized",
+        404: "Conversation not found"
+    }
+)
+class MarkReadView(APIView):
+    """
+        Endpoint to mark a whole range of messages as read at once.
+
+        Costs one UPDATE on messages and one on the unread counter, regardless of how many messages are marked.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, user_id):
+        serializer = MarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        user_low_id, user_high_id = sorted((request.user.id, user_id))
+        conversation = get_object_or_404(Conversation, user_low_id=user_low_id, user_high_id=user_high_id)
+        up_to = serializer.validated_data.get("up_to")
+        up_to_uid = serializer.validated_data.get("up_to_uid")
+        up_to_uid = str(up_to_uid) if up_to_uid is not None else None
+        count = ConversationSummary.mark_read(request.user.id, conversation.id, up_to, up_to_uid)
+        if count:
+            receipt = {
+                "type": "read_receipt",
+                "reader": request.user.id,
+                "up_to": up_to,
+                "up_to_uid": up_to_uid,
+            }
+            group_send(conversation.group_name, dict(receipt, text=event_text(receipt)))
+
+        return Response({"marked": count}, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    summary="Unread Message Counts",
+    description=(
+        "Returns the unread message count of every conversation of the current user that has unread messages."
+        "\nRoute: `/unread-counts/` \n\n"
+    ),
+    request=None,
+    responses={
+        200: UnreadCountSerializer(many=True),
+        401: "Unauthorized"
+    }
+)
+class UnreadCountsView(APIView):
+    """
+        Endpoint to retrieve badge counts.
+
+        Reads the counters kept in `ConversationSummary`, so it never scans messages.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        summaries = ConversationSummary.objects.filter(
+            user_id=request.user.id, unread_count__gt=0,
+        ).select_related('conversation')
+
+        counts = [
+            {
+                "conversation": summary.conversation_id,
+                "user_id": summary.conversation.other_user_id(request.user.id),
+                "unread_count": summary.unread_count,
+            }
+            for summary in summaries
+        ]
+        return Response(UnreadCountSerializer(counts, many=True).data)
+
 
 @extend_schema(
     summary="Retrieve or Update User Profile",
@@ -322,6 +602,17 @@ class ProfileDetailView(generics.RetrieveUpdateDestroyAPIView):
 
     permission_classes = [IsAuthenticated]
 
+    def retrieve(self, request, *args, **kwargs):
+        pk = self.kwargs['pk']
+        user_id = profile_owner(
+            pk, lambda: get_object_or_404(Profile.objects.values_list('user_id', flat=True), pk=pk)
+        )
+        # absolute photo URLs depend on the host the request came through
+        kind = f"detail@{request.get_host()}"
+        return cached_profile_response(
+            request, kind, user_id, lambda: self.get_serializer(self.get_object()).data
+        )
+
 
 @extend_schema(
     summary="Search for Users",
@@ -339,7 +630,8 @@ class UserSearch(generics.ListAPIView):
     """
         Endpoint to search for users by their username, name, or email.
 
-        The search term is passed as a URL parameter `username`.
+        The search term is passed as a URL parameter `username`. Prefix matches come first.
+        At most `SEARCH_RESULT_LIMIT` profiles are ranked; they are paginated with `limit`/`offset`.
     """
     serializer_class = ProfileSerializer
     queryset = Profile.objects.all()
@@ -347,21 +639,17 @@ class UserSearch(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     def list(self, req, *args, **kwargs):
         username = self.kwargs['username']
-        users = Profile.objects.filter(
-            Q(user__username__icontains=username) |
-            Q(name__icontains=username) |
-            Q(user__email__icontains=username)
-        )
+        users = search_profiles(username)
 
-        if not users.exists():
+        if not users:
             return Response(
                 {
                     "detail": "No users found"
                 }, status=status.HTTP_404_NOT_FOUND
             )
         
-        serializer = self.get_serializer(users, many=True)
-        return Response(serializer.data)
+        serializer = self.get_serializer(self.paginate_queryset(users), many=True)
+        return self.get_paginated_response(serializer.data)
     
 
 
@@ -410,9 +698,10 @@ class UserProfileView(APIView):
         - 404 Not Found: The profile for the user does not exist.
         """
         try:
-            profile = Profile.objects.get(user=request.user)
-            serializer = ProfileSerializer(profile)
-            return Response(serializer.data)
+            return cached_profile_response(
+                request, "own", request.user.id,
+                lambda: ProfileSerializer(Profile.objects.get(user=request.user)).data,
+            )
         except Profile.DoesNotExist:
             return Response({"detail": "Profile not found"}, status=404)
 
@@ -478,9 +767,13 @@ class ProfileView(APIView):
 
     def get(self, request):
         user = request.user
+        return cached_profile_response(request, "summary", user.id, lambda: self.summary(user))
+
+    @staticmethod
+    def summary(user):
         profile = user.profile
 
-        return Response({
+        return {
             "name": profile.name,
             "gender": profile.gender,
             "email": user.email,
@@ -488,5 +781,5 @@ class ProfileView(APIView):
             "is_online": profile.is_online,
             "bio": profile.bio,
             "photo": str(profile.photo),
-        })
+        }
     
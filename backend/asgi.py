@@ -3,25 +3,54 @@ ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+WebSocket compression (permessage-deflate) is negotiated by the server,
+not by this application; see backend/websocket.py. The lifespan protocol
+is only used at shutdown, see ``lifespan``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
+import logging
 import os
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
 import django
 django.setup()  
 
 import api.routing
+from api.middleware import JWTAuthMiddleware
+from api.presence import broadcaster
+
+logger = logging.getLogger(__name__)
+
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan. uvicorn sends the shutdown event once every socket has
+    closed, so presence deltas published by their disconnect handlers and
+    still in their broadcast window are sent here, before the loop stops.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            try:
+                await broadcaster.drain()
+            except Exception:
+                logger.exception("Could not send pending presence deltas")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(), 
-    "websocket": AuthMiddlewareStack(
+    "websocket": JWTAuthMiddleware(
         URLRouter(api.routing.websocket_urlpatterns)
     ),
+    "lifespan": lifespan,
 })
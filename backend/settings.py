@@ -101,6 +101,75 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Presence tracking (api/online_tracker.py)
+PRESENCE_REDIS_URL = os.getenv('PRESENCE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+# Seconds a connection stays online without a heartbeat
+PRESENCE_TTL = 60
+PRESENCE_HEARTBEAT_INTERVAL = 20
+# Seconds between batched writes of presence changes to Profile.is_online
+PRESENCE_SYNC_INTERVAL = 5
+# Seconds presence changes are coalesced before one batched broadcast
+PRESENCE_BROADCAST_WINDOW = 0.25
+# Seconds a user's contact list (who sees their presence) is cached
+PRESENCE_CONTACTS_TTL = 600
+
+# Chat persistence (api/message_queue.py). With write-behind enabled
+# ChatConsumer queues messages in Redis and the write_messages command
+# stores them in batches of CHAT_WRITE_BATCH_SIZE, at least every
+# CHAT_WRITE_INTERVAL seconds.
+CHAT_WRITE_BEHIND = True
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_INTERVAL = 0.2
+# Seconds after its last heartbeat a writer's unfinished batch is taken
+# over by another writer. Several writer processes may run at once.
+CHAT_WRITER_TTL = 60
+
+# Chat protocol v2 (ws/chat/...?protocol=2, see api.consumers.ChatConsumer)
+# Seconds outbound events are collected before they go out as one frame
+CHAT_FLUSH_WINDOW = 0.05
+# Maximum number of operations in one inbound frame
+CHAT_MAX_FRAME_ITEMS = 100
+# Seconds a client_id is remembered in Redis to drop retried messages
+CHAT_DEDUP_TTL = 86400
+
+# Maximum number of profiles UserSearch ranks (api/search.py); the
+# results are then paginated with limit/offset
+SEARCH_RESULT_LIMIT = 100
+
+# Seconds a changed task or message is held back from delta sync
+# (/todo-sync/, /sync-messages/): updated_at is set before commit, and a row
+# committed after a client synced past its timestamp would be skipped
+SYNC_SAFETY_LAG = 2
+
+# Maximum number of operations in one /todo-batch/ request
+TASK_BATCH_MAX_OPERATIONS = 500
+
+# Serialized profiles (api/cache.py), invalidated by version on every change
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    }
+}
+# Seconds a cached profile representation is kept
+PROFILE_CACHE_TIMEOUT = 300
+# Seconds a user resolved from a JWT (REST and WebSocket) is cached (api/authentication.py)
+AUTH_USER_CACHE_TIMEOUT = 60
+
+# permessage-deflate for WebSocket frames, negotiated by the server protocol
+# (backend/websocket.py). Messages shorter than the threshold (bytes of
+# payload) go out uncompressed; small chat frames barely shrink and still
+# cost a compressor call.
+WS_COMPRESSION = os.getenv('WS_COMPRESSION', '1') == '1'
+WS_COMPRESSION_THRESHOLD = int(os.getenv('WS_COMPRESSION_THRESHOLD', 512))
+# zlib level (1 fastest .. 9 smallest) and per-connection memory: window bits
+# (9..15) and memLevel (1..9)
+WS_COMPRESSION_LEVEL = 6
+WS_COMPRESSION_WINDOW_BITS = 12
+WS_COMPRESSION_MEM_LEVEL = 5
+# Seconds between flushes of the compression counters to api.metrics
+WS_COMPRESSION_METRICS_INTERVAL = 10
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
@@ -140,6 +209,11 @@ if 'test' in sys.argv:
             'PORT': '5432',
         }
     }
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
 
 
 # Password validation
@@ -194,9 +268,21 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.CachedJWTAuthentication',
+    ),
+    # orjson when installed, see api/serialization.py
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.serialization.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'api.serialization.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.StandardLimitOffsetPagination',
+    'PAGE_SIZE': 20,
 
 }
 
@@ -0,0 +1,146 @@
+"""
+permessage-deflate (RFC 7692) for the WebSocket routes in backend/asgi.py.
+
+Compression is negotiated by the server protocol during the handshake, below
+the ASGI application, so it is enabled by running uvicorn with this protocol:
+
+    uvicorn backend.asgi:application --ws backend.websocket:CompressedWebSocketProtocol
+
+Clients that do not offer the extension, and servers started without
+``--ws-per-message-deflate`` (on by default), get uncompressed frames.
+Messages shorter than ``WS_COMPRESSION_THRESHOLD`` are sent uncompressed even
+when it was negotiated. Bytes before and after compression are counted in the
+``ws_compression`` metrics (``manage.py show_metrics``).
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from django.conf import settings
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CONT, CTRL_OPCODES
+
+logger = logging.getLogger(__name__)
+
+METRICS_NAMESPACE = "ws_compression"
+
+# summed over every connection of this process between flushes
+_counters = Counter()
+_last_flush = time.monotonic()
+
+
+def _write_counters(counts):
+    from api import metrics
+
+    try:
+        metrics.incr(METRICS_NAMESPACE, **counts)
+    except Exception:
+        logger.exception("could not write WebSocket compression counters")
+
+
+def flush_counters():
+    """
+    Adds the counters collected since the last flush to api.metrics. Called
+    from ``count`` at most every ``WS_COMPRESSION_METRICS_INTERVAL`` seconds;
+    the Redis write runs in a thread so sending never waits for it.
+    """
+    global _last_flush
+    _last_flush = time.monotonic()
+    if not _counters:
+        return
+    counts = dict(_counters)
+    _counters.clear()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write_counters(counts)
+    else:
+        loop.run_in_executor(None, _write_counters, counts)
+
+
+def count(**counts):
+    _counters.update(counts)
+    if time.monotonic() - _last_flush >= settings.WS_COMPRESSION_METRICS_INTERVAL:
+        flush_counters()
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """
+    ``PerMessageDeflate`` that leaves messages below ``threshold`` bytes
+    uncompressed (RSV1 unset, which the RFC allows per message) and counts
+    raw and wire bytes of everything it sends.
+    """
+
+    def __init__(self, *args, threshold=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+
+        size = len(frame.data)
+        # only whole messages can be skipped: once the first frame of a
+        # fragmented message is compressed the rest must be too
+        if frame.fin and frame.opcode is not CONT and size < self.threshold:
+            count(messages_skipped=1, raw_bytes=size, wire_bytes=size)
+            return frame
+
+        encoded = super().encode(frame)
+        if frame.opcode is CONT:
+            count(raw_bytes=size, wire_bytes=len(encoded.data))
+        else:
+            count(messages_compressed=1, raw_bytes=size, wire_bytes=len(encoded.data))
+        return encoded
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    """
+    Negotiates permessage-deflate like websockets' factory and hands out
+    ``ThresholdPerMessageDeflate`` extensions.
+    """
+
+    def __init__(self, *args, threshold=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            server_max_window_bits=settings.WS_COMPRESSION_WINDOW_BITS,
+            client_max_window_bits=settings.WS_COMPRESSION_WINDOW_BITS,
+            compress_settings={
+                "level": settings.WS_COMPRESSION_LEVEL,
+                "memLevel": settings.WS_COMPRESSION_MEM_LEVEL,
+            },
+            threshold=settings.WS_COMPRESSION_THRESHOLD,
+        )
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            threshold=self.threshold,
+        )
+
+
+class CompressedWebSocketProtocol(WebSocketsSansIOProtocol):
+    """
+    uvicorn's default WebSocket protocol with the deflate settings and
+    threshold from settings.py instead of uvicorn's fixed ones.
+    ``WS_COMPRESSION = False`` turns compression off entirely.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate and settings.WS_COMPRESSION:
+            self.conn.available_extensions = [ThresholdPerMessageDeflateFactory.from_settings()]
+        else:
+            self.conn.available_extensions = []
+
@@ -0,0 +1,61 @@
+"""
+gunicorn worker for the ASGI application (see gunicorn.conf.py).
+"""
+import logging
+import re
+
+from uvicorn_worker import UvicornWorker as BaseUvicornWorker
+
+# seconds between the end of uvicorn's drain and gunicorn's SIGKILL
+SHUTDOWN_MARGIN = 2
+
+_TOKEN_IN_QUERY = re.compile(r"([?&]token=)[^&\s\"]*")
+
+
+def redact_token(text):
+    return _TOKEN_IN_QUERY.sub(r"\1[redacted]", text)
+
+
+class RedactTokenFilter(logging.Filter):
+    """
+    Masks ``?token=<jwt>`` (api/middleware.py) in log records, e.g. the
+    WebSocket handshake lines uvicorn logs with the full path.
+    """
+
+    def filter(self, record):
+        if isinstance(record.msg, str):
+            record.msg = redact_token(record.msg)
+        if isinstance(record.args, tuple):
+            record.args = tuple(redact_token(arg) if isinstance(arg, str) else arg for arg in record.args)
+        return True
+
+
+class UvicornWorker(BaseUvicornWorker):
+    """
+    The uvicorn-worker package's gunicorn worker with the WebSocket protocol
+    from backend/websocket.py (permessage-deflate with a threshold) and the
+    ASGI lifespan of backend/asgi.py.
+
+    On SIGTERM (deploys, ``kill -TERM`` of the arbiter) the worker stops
+    accepting connections and closes every WebSocket with 1012 (service
+    restart), so consumers run ``disconnect`` (presence, pending chat
+    frames) and clients reconnect to another worker. Requests and
+    disconnect handlers still running get until just before
+    ``graceful_timeout``, when gunicorn kills the worker. Presence deltas
+    still waiting for their broadcast window are sent at lifespan shutdown,
+    which uvicorn runs after the sockets closed.
+    """
+
+    CONFIG_KWARGS = {
+        "loop": "auto",
+        "http": "auto",
+        "ws": "backend.websocket:CompressedWebSocketProtocol",
+        "lifespan": "on",
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # uvicorn logs WebSocket handshakes with the query string
+        for name in ("uvicorn.error", "uvicorn.access"):
+            logging.getLogger(name).addFilter(RedactTokenFilter())
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - SHUTDOWN_MARGIN, 1)
@@ -0,0 +1,35 @@
+"""
+gunicorn settings for the web process (Procfile):
+
+    gunicorn backend.asgi:application -c gunicorn.conf.py
+
+Serves HTTP and the WebSocket routes (api/routing.py) from uvicorn workers
+(backend/workers.py). Each worker is one event loop handling many requests
+and sockets at once; blocking ORM calls run in Channels' thread pool.
+Measure a deployment with ``manage.py bench_server``.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# One event loop per worker, so one worker per core rather than gunicorn's
+# usual 2 * cores + 1 for sync workers.
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'backend.workers.UvicornWorker'
+
+# Seconds a worker may go without notifying the arbiter before it is restarted
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+# Seconds a stopping worker has to drain (close WebSockets with 1012 and
+# finish running requests) before it is killed
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+# Seconds an idle HTTP keep-alive connection is held open
+keepalive = 5
+
+# Restart a worker after this many requests (0 = never), with jitter so
+# workers don't restart together
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 0))
+
+accesslog = '-'
+errorlog = '-'